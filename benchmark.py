@@ -0,0 +1,271 @@
+# benchmark.py
+# Render benchmark on synthetic question banks.
+#
+#   python benchmark.py                         # 10, 100, 1000, 10000 questions
+#   python benchmark.py --sizes 10,100000 --out bench_results.json
+#   python benchmark.py --compare bench_results.json   # exit 1 on a >25% stage regression
+#
+# Each bank size runs in a fresh process so peak RSS is per size.  Stages are
+# timed separately: parse, images, layout, page_map (the prefix-sum page fit),
+# ms_tables, render (canvas replay + save) and, optionally, the streaming build.
+# The text measurement caches are emptied before each stage, so a stage that
+# runs after layout is not credited with the widths and Paragraphs layout left
+# behind.
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse, json, multiprocessing, os, platform, random, resource, shutil, sys, tempfile, time
+
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+QUESTIONS_PER_TOPIC = 40
+
+SERIES = ["May/Jun 2014", "Oct/Nov 2015", "May/Jun 2016", "Oct/Nov 2017", "May/Jun 2018",
+          "Oct/Nov 2019", "Specimen 2020", "May/Jun 2021", "Oct/Nov 2022", "May/Jun 2023"]
+PHRASES = [
+    "Define the term", "State what is meant by", "Explain why", "Calculate the", "Describe an experiment to measure",
+    "Sketch a graph showing", "Suggest a reason for", "Determine the", "Compare the", "State one advantage of",
+]
+NOUNS = [
+    "potential difference", "resistance of the filament lamp", "specific heat capacity", "half-life of the sample",
+    "wavelength of the wave", "acceleration of the trolley", "pressure exerted by the gas", "efficiency of the motor",
+    "refractive index of the glass", "current in the circuit", "momentum of the ball", "activity of the source",
+]
+ANSWERS = [
+    "Work done per unit charge moving between two points.", "R = V / I = 12 / 2.0 = 6.0 Ω",
+    "Fastest molecules escape; average KE of remaining molecules decreases; temperature falls.",
+    "Time for activity/mass to halve.", "λ of light is much smaller than gap size, so diffraction is negligible.",
+    "Energy required to change state of unit mass without temperature change.",
+]
+# long marking-scheme answers: hyphenated words are where reportlab's line breaks differ from a plain wrap
+ANSWER_PHRASES = [
+    "half-life is constant", "the count-rate falls", "use a G-M tube", "subtract the background count",
+    "energy is transferred to the surroundings", "the p.d. across the lamp increases", "non-uniform field",
+    "light-dependent resistor", "the x-axis shows time", "thermal energy by conduction", "self-consistent units",
+]
+
+
+def _answer(rng):
+    if rng.random() < 0.2:
+        return "; ".join(rng.choice(ANSWER_PHRASES) for _ in range(rng.randint(10, 40))) + "."
+    return rng.choice(ANSWERS)
+
+
+def _sentence(rng, marks):
+    words = f"{rng.choice(PHRASES)} the {rng.choice(NOUNS)}"
+    extra = " ".join(rng.choice(NOUNS) for _ in range(rng.randint(0, 6)))
+    return f"{words}{' and ' + extra if extra else ''}. [{marks}]"
+
+
+def make_figure(dirpath):
+    """A small local PNG used by the image-bearing parts."""
+    path = os.path.join(dirpath, "bench_figure.png")
+    from PIL import Image, ImageDraw
+    img = Image.new("L", (1200, 700), 255)
+    draw = ImageDraw.Draw(img)
+    for x in range(0, 1200, 60):
+        draw.line([(x, 0), (x, 700)], fill=200)
+    draw.line([(0, 650), (1150, 50)], fill=0, width=6)
+    img.save(path)
+    return path
+
+
+def synthetic_bank(n, seed=0, figure=None):
+    """n question records shaped like the real bank (parts, marks, sketches, images)."""
+    rng = random.Random(seed)
+    n_topics = max(1, n // QUESTIONS_PER_TOPIC)
+    questions = []
+    for i in range(n):
+        topic = i * n_topics // n
+        last_in_topic = (i + 1) * n_topics // n != topic or i == n - 1
+        series = rng.choice(SERIES)
+        q = {
+            "chapter_title": f"Topic {topic + 1:04d}",
+            "exam_series": series,
+            "subject": "Physics 5054",
+            "original_ref": f"5054_{'s' if 'May' in series else 'w'}{series[-2:]}_qp_{rng.choice([11, 12, 21, 22])} Q{i + 1}",
+            "question_number": str(i + 1),
+            "end_of_topic": last_in_topic,
+        }
+        n_parts = rng.choice([0, 0, 1, 2, 3, 3, 4, 5])
+        if n_parts == 0:
+            marks = rng.randint(1, 8)
+            q["marks"] = marks
+            q["question_text"] = _sentence(rng, marks)
+            q["answer_text"] = {"a": _answer(rng)}
+            if rng.random() < 0.15:
+                q["sketch"] = True
+                q["sketch_only"] = rng.random() < 0.5
+        else:
+            labels = "abcdefgh"[:n_parts]
+            part_marks = [rng.randint(1, 5) for _ in labels]
+            intro = "A student investigates the circuit shown.\n\n" if rng.random() < 0.4 else ""
+            q["question_text"] = intro + "\n\n".join(f"({l}) {_sentence(rng, m)}" for l, m in zip(labels, part_marks))
+            q["marks"] = sum(part_marks)
+            q["answer_text"] = {l: _answer(rng) for l in labels}
+            sketched = [l for l in labels if rng.random() < 0.2]
+            if sketched:
+                q["sketch"] = {l: True for l in sketched}
+                q["sketch_only"] = {l: rng.random() < 0.5 for l in sketched}
+            if figure and rng.random() < 0.1:
+                q["image"] = {rng.choice(labels): figure}
+        questions.append(q)
+    return questions
+
+
+def divider_pages_alone(layout):
+    """True if every topic divider page holds only the divider (plus header rule and page number)."""
+    for topic, n in layout.topic_divider_pages.items():
+        blocks = layout.emitted_pages[n - 1].blocks
+        texts = [b[3] for b in blocks if b[0] == "text"]
+        others = [b for b in blocks if b[0] not in ("text", "page_number") and b[:2] != ("form", "header_rule")]
+        if texts != [topic, "Topical Past Papers"] or others:
+            return False
+    return True
+
+
+def layout_checks(g, raw, images):
+    """(page map matches, dividers alone) for a reordered, filtered selection of raw,
+    where end_of_topic no longer falls on the last question of every topic."""
+    questions = g.normalize_questions(g.select_questions(raw, {"max_marks": 12}, ["-year"]))
+    topics = list(dict.fromkeys(q.chapter_title for q in questions))
+    layout = g.layout_booklet(questions, topics, g.DEFAULT_TITLE, images)
+    return g.page_map(questions, topics, images) == layout.page_map(), divider_pages_alone(layout)
+
+
+def clear_text_caches(g):
+    """Empty the per-process text measurement caches, so the next stage is timed cold.
+
+    Parsed questions (_parse_memo) are kept: they are the parse stage's output,
+    which every later stage consumes, as in a real build.
+    """
+    g.word_width.cache_clear()
+    g.tidy_text_for_math.cache_clear()
+    g.paragraph_line_count.cache_clear()
+    g._paragraph_local.__dict__.pop("cache", None)
+
+
+def run_size(n, seed=0, stream=False):
+    """Benchmark one bank size; runs inside a fresh worker process."""
+    import generate_pdf as g
+    from reportlab.pdfgen import canvas
+
+    tmp = tempfile.mkdtemp(prefix="ppp-bench-")
+    figure = make_figure(tmp)
+    raw = synthetic_bank(n, seed, figure)
+    stages = {}
+
+    def timed(name, fn, *args):
+        clear_text_caches(g)
+        t0 = time.perf_counter()
+        out = fn(*args)
+        stages[name] = time.perf_counter() - t0
+        return out
+
+    questions = timed("normalize", g.normalize_questions, raw)
+    topics = list(dict.fromkeys(q.chapter_title for q in questions))
+    g._parse_memo.clear()
+    timed("parse", lambda: [g.parse_question(q) for q in questions])
+    images = timed("images", lambda: g.prepare_images(
+        g.prefetch_images(g.collect_image_refs(questions)), g.IMAGE_BOX_W, g.IMAGE_BOX_H,
+        cache_dir=os.path.join(tmp, "prepared")))
+    layout = timed("layout", g.layout_booklet, questions, topics, g.DEFAULT_TITLE, images)
+    fast_map = timed("page_map", g.page_map, questions, topics, images)
+
+    by_topic = {}
+    for q in questions:
+        by_topic.setdefault(q.chapter_title, []).append(q)
+    timed("ms_tables", lambda: [g.split_ms_table(g.build_ms_table(qs)) for qs in by_topic.values()])
+
+    out_path = os.path.join(tmp, "bench.pdf")
+
+    def render():
+        c = canvas.Canvas(out_path, pagesize=g.A4)
+        g.render_layout(c, layout)
+        c.save()
+    timed("render", render)
+    output_bytes = os.path.getsize(out_path)
+
+    if stream:
+        stream_path = os.path.join(tmp, "bench_stream.pdf")
+        timed("stream_build", g.BookletBuilder(raw, stream_path).build_streaming)
+        os.remove(stream_path)
+
+    # untimed: the same checks on a selection sorted and filtered away from bank order
+    reordered_map_matches, reordered_dividers_alone = layout_checks(g, raw[:2000], images)
+
+    shutil.rmtree(tmp, ignore_errors=True)
+    return {
+        "questions": n,
+        "topics": len(topics),
+        "pages": layout.page_count,
+        "page_map_matches": fast_map == layout.page_map() and reordered_map_matches,
+        "dividers_alone": divider_pages_alone(layout) and reordered_dividers_alone,
+        "stages": {k: round(v, 4) for k, v in stages.items()},
+        "total_seconds": round(sum(stages.values()), 4),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "output_bytes": output_bytes,
+    }
+
+
+def compare(results, baseline_path, threshold):
+    """Print per-stage ratios against a previous results file; return True if any stage regressed."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {r["questions"]: r for r in json.load(f)["results"]}
+    regressed = False
+    for r in results:
+        old = baseline.get(r["questions"])
+        if not old:
+            continue
+        for stage, secs in r["stages"].items():
+            before = old["stages"].get(stage)
+            if not before or before < 0.01:
+                continue   # too small to compare meaningfully
+            ratio = secs / before
+            flag = "REGRESSION" if ratio > threshold else ""
+            regressed |= bool(flag)
+            print(f"{r['questions']:>7} {stage:<13} {before:9.3f}s -> {secs:9.3f}s  x{ratio:5.2f} {flag}")
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark layout and render stages on synthetic banks.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="comma-separated question counts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stream", action="store_true", help="also time a full streaming build")
+    parser.add_argument("--out", default="bench_results.json", help="JSON results file (default: %(default)s)")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against a previous results file")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio counted as a regression")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    results = []
+    # one fresh process per size, so peak RSS isn't inherited from a larger run
+    ctx = multiprocessing.get_context("spawn")
+    for n in sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            r = pool.submit(run_size, n, args.seed, args.stream).result()
+        results.append(r)
+        stages = "  ".join(f"{k}={v:.3f}s" for k, v in r["stages"].items())
+        print(f"{n:>7} questions  {r['pages']:>6} pages  {r['peak_rss_kb'] / 1024:7.1f} MB  "
+              f"{r['output_bytes'] / 1024:9.1f} KB  {stages}")
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    if args.compare:
+        regressed = compare(results, args.compare, args.threshold)
+    else:
+        regressed = False
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to:", args.out)
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
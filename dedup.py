@@ -0,0 +1,142 @@
+# dedup.py
+# Repeated questions: the same item set in several exam series ("Define
+# half-life.") should appear in a booklet once.
+#
+# Questions are keyed on their normalized text (case, punctuation, spacing and
+# mark allocations such as "[2]" ignored) together with their figure references,
+# since the same wording over a different diagram is a different question.  An
+# exact index on that key catches verbatim repeats.  With a similarity threshold,
+# near-duplicates are found too: each text is cut into word shingles, a MinHash
+# signature is banded into LSH buckets, and only questions that share a bucket
+# have their shingle sets compared (Jaccard similarity).  The first copy in
+# selection order is always the one kept.
+#
+# The signature is a one-permutation MinHash: every shingle is hashed once into
+# one of NUM_PERM bins and each bin keeps its minimum (empty bins borrow from
+# the next filled one), so signing costs one hash per shingle, not NUM_PERM.
+
+import re, json, zlib
+
+_MARKS_RE = re.compile(r"\[\s*\d+\s*\]")
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+SHINGLE_WORDS = 3
+NUM_PERM = 32
+BANDS = 8     # NUM_PERM / BANDS rows per band: pairs from ~0.6 similarity become candidates
+# a band bucket shared by more questions than this holds stock phrasing ("calculate the
+# current in the circuit"), not repeats, and no longer yields candidates
+MAX_BUCKET = 64
+
+
+def normalize_text(text):
+    """Lower-cased words of text without punctuation or mark allocations."""
+    text = _MARKS_RE.sub(" ", text or "")
+    return " ".join(_NON_WORD_RE.sub(" ", text.casefold()).split())
+
+
+def shingles(words, k=SHINGLE_WORDS):
+    """Set of k-word shingles (a shorter text is one shingle)."""
+    if len(words) <= k:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+
+def minhash(shingle_set):
+    """NUM_PERM-value signature of a non-empty shingle set (stable across runs)."""
+    sig = [None] * NUM_PERM
+    for s in shingle_set:
+        h = zlib.crc32(s.encode("utf-8"))
+        i, v = h % NUM_PERM, h // NUM_PERM
+        if sig[i] is None or v < sig[i]:
+            sig[i] = v
+    # densify: an empty bin takes the next filled bin's value, tagged with the distance
+    for i in range(NUM_PERM):
+        if sig[i] is None:
+            d = 1
+            while sig[(i + d) % NUM_PERM] is None or isinstance(sig[(i + d) % NUM_PERM], tuple):
+                d += 1
+            sig[i] = (d, sig[(i + d) % NUM_PERM])
+    return sig
+
+
+class DuplicateIndex:
+    """Streaming duplicate finder: add() each question in order and get back the
+    position of the earlier copy it repeats, or None for a new question.
+
+    similarity: None for exact matches only, else the Jaccard similarity of
+    word shingles (e.g. 0.8) from which two questions count as duplicates.
+    """
+    def __init__(self, similarity=None):
+        self.similarity = similarity
+        self._exact = {}
+        self._buckets = {}     # (band, band hash) -> positions of kept questions
+        self._kept = {}        # position -> (figure key, shingle set) of kept questions
+
+    def add(self, pos, text, figures=None):
+        """Index the question at pos; returns the position of its earlier copy or None."""
+        figures = json.dumps(figures, sort_keys=True) if figures else ""
+        norm = normalize_text(text)
+        key = (norm, figures)
+        if key in self._exact:
+            return self._exact[key]
+        self._exact[key] = pos
+        if self.similarity is None or not norm:
+            return None
+
+        sh = shingles(norm.split())
+        sig = minhash(sh)
+        rows = NUM_PERM // BANDS
+        bands = [(b, hash(tuple(sig[b * rows:(b + 1) * rows]))) for b in range(BANDS)]
+        candidates = set()
+        for band in bands:
+            bucket = self._buckets.get(band, ())
+            if len(bucket) <= MAX_BUCKET:
+                candidates.update(bucket)
+        for other in sorted(candidates):
+            other_figures, other_sh = self._kept[other]
+            if other_figures != figures:
+                continue
+            common = len(sh & other_sh)
+            if common >= self.similarity * (len(sh) + len(other_sh) - common):
+                self._exact[key] = other
+                return other
+        self._kept[pos] = (figures, sh)
+        for band in bands:
+            self._buckets.setdefault(band, []).append(pos)
+        return None
+
+
+def find_duplicates(questions, similarity=None, text=None):
+    """{position of a repeat: position of the copy kept} over a list of records.
+
+    text(record) gives the wording to compare (default: question_text).
+    """
+    index = DuplicateIndex(similarity)
+    repeats = {}
+    for pos, q in enumerate(questions):
+        wording = text(q) if text else q.get("question_text")
+        first = index.add(pos, wording, q.get("image"))
+        if first is not None:
+            repeats[pos] = first
+    return repeats
+
+
+def dedup_questions(questions, mode="collapse", similarity=None, text=None):
+    """Return (questions, repeats) with repeats as from find_duplicates.
+
+    mode "collapse" drops every repeat; "flag" keeps the list as it is and
+    only reports them.  A dropped end_of_topic question hands its flag to the
+    last question left in its topic (a copy; the caller's records are untouched).
+    """
+    questions = list(questions)
+    repeats = find_duplicates(questions, similarity, text)
+    if mode == "collapse" and repeats:
+        ended = {questions[pos].get("chapter_title") for pos in repeats if questions[pos].get("end_of_topic")}
+        questions = [q for pos, q in enumerate(questions) if pos not in repeats]
+        for pos in range(len(questions) - 1, -1, -1):
+            q = questions[pos]
+            if q.get("chapter_title") in ended:
+                ended.discard(q.get("chapter_title"))
+                if not q.get("end_of_topic"):
+                    questions[pos] = dict(q, end_of_topic=True)
+    return questions, repeats
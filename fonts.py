@@ -0,0 +1,131 @@
+# fonts.py
+# Font registry: the faces the booklet is set in are resolved once per process.
+#
+# The standard PDF fonts (Helvetica, Times) only cover WinAnsi, so the
+# superscript digits tidy_text_for_math produces (⁴ to ⁹, ⁻) come out as
+# missing-glyph boxes and Greek is borrowed from the Symbol font.  When a TTF
+# family with wider coverage is installed it is registered once and used for
+# every role; reportlab embeds only the glyphs a document actually uses, so the
+# output stays small.  Without one the standard fonts are used as before.
+#
+# PPP_FONT_DIR adds a directory to search; PPP_FONTS=standard forces the
+# standard fonts (e.g. to match booklets built on a machine without TTFs).
+#
+# Resolving the roles only finds the files.  A face is parsed and registered on
+# first use (load_font), so a page-map-only run loads just the body face.
+
+import os, threading
+from functools import lru_cache
+from reportlab.pdfbase import pdfmetrics
+
+STANDARD_FONTS = {
+    "sans": "Helvetica",
+    "sans_bold": "Helvetica-Bold",
+    "sans_italic": "Helvetica-Oblique",
+    "serif_bold": "Times-Bold",
+}
+
+# role -> file name; a family is used when its "sans" and "sans_bold" faces exist
+TTF_FAMILIES = [
+    ("DejaVu", {
+        "sans": "DejaVuSans.ttf",
+        "sans_bold": "DejaVuSans-Bold.ttf",
+        "sans_italic": "DejaVuSans-Oblique.ttf",
+        "serif_bold": "DejaVuSerif-Bold.ttf",
+    }),
+    ("Liberation", {
+        "sans": "LiberationSans-Regular.ttf",
+        "sans_bold": "LiberationSans-Bold.ttf",
+        "sans_italic": "LiberationSans-Italic.ttf",
+        "serif_bold": "LiberationSerif-Bold.ttf",
+    }),
+]
+# a missing optional face falls back to another face of the same family
+ROLE_FALLBACK = {"sans_italic": "sans", "serif_bold": "sans_bold"}
+
+TTF_DIRS = [
+    "/usr/share/fonts/truetype/dejavu",
+    "/usr/share/fonts/dejavu",
+    "/usr/share/fonts/truetype/liberation",
+    "/usr/share/fonts/liberation-sans",
+    "/usr/share/fonts/TTF",
+    "/Library/Fonts",
+    os.path.join(os.path.expanduser("~"), ".fonts"),
+    os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts"),
+]
+
+
+# font name -> TTF path for faces resolved but not registered yet
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def _find(filename, dirs):
+    for d in dirs:
+        path = os.path.join(d, filename)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+@lru_cache(maxsize=None)
+def font_roles():
+    """{role: registered font name} for this process (see STANDARD_FONTS for the roles)."""
+    if os.environ.get("PPP_FONTS", "").lower() == "standard":
+        return dict(STANDARD_FONTS)
+    dirs = ([os.environ["PPP_FONT_DIR"]] if os.environ.get("PPP_FONT_DIR") else []) + TTF_DIRS
+    for family, faces in TTF_FAMILIES:
+        paths = {role: _find(name, dirs) for role, name in faces.items()}
+        if not (paths["sans"] and paths["sans_bold"]):
+            continue
+        roles = {}
+        for role in STANDARD_FONTS:
+            path = paths.get(role) or paths[ROLE_FALLBACK[role]]
+            name = f"{family}-{os.path.splitext(os.path.basename(path))[0]}"
+            if name not in pdfmetrics.getRegisteredFontNames():
+                _pending[name] = path
+            roles[role] = name
+        # so <b>/<i> inside Paragraph markup resolve to the same family
+        pdfmetrics.registerFontFamily(roles["sans"], normal=roles["sans"], bold=roles["sans_bold"],
+                                      italic=roles["sans_italic"], boldItalic=roles["sans_bold"])
+        return roles
+    return dict(STANDARD_FONTS)
+
+
+def load_font(name):
+    """Register the face called name if it is still pending (no-op otherwise)."""
+    if name not in _pending:
+        return
+    from reportlab.pdfbase.ttfonts import TTFont
+    with _pending_lock:
+        # stays pending until registered, so other threads wait on the lock meanwhile
+        path = _pending.get(name)
+        if path:
+            pdfmetrics.registerFont(TTFont(name, path))
+            del _pending[name]
+
+
+def load_all_fonts():
+    """Register every pending face (before drawing or building Paragraphs)."""
+    for name in list(_pending):
+        load_font(name)
+
+
+def seed_subsets(canv, chars):
+    """Give chars their subset codes on canv's document up front, in every TTF role.
+
+    reportlab numbers a TTF's glyphs in order of first use and names each face
+    by when it is first drawn, so two PDFs showing different text embed
+    different subsets of the same face.  Seeding every piece of a segmented
+    render with the same sorted repertoire makes their font objects
+    byte-identical, and pdf_concat keeps one copy.  Characters missing from
+    chars still draw; they only make that piece's subsets differ.
+    """
+    load_all_fonts()
+    doc = canv._doc
+    chars = "".join(sorted(set(chars) | set(map(chr, range(32, 127)))))
+    for role in STANDARD_FONTS:
+        font = pdfmetrics.getFont(font_roles()[role])
+        if getattr(font, "_dynamicFont", False):
+            font.splitString(chars, doc)
+            font.getSubsetInternalName(0, doc)
@@ -1,30 +1,42 @@
 # make_pdf_with_end_of_topic_fixed.py
-# Adds support for explicit end_of_topic markers to force fresh divider pages,
-# improves simulation parity, and prints actual divider/MS page numbers during render.
+# Adds support for explicit end_of_topic markers to force fresh divider pages.
+# The booklet is laid out once (LayoutEngine) and the renderer replays that layout,
+# so the TOC page numbers always match the rendered pages.
 
+# Only the layout core is imported up front: the canvas, platypus, image readers,
+# the process pool and (in image_cache) the HTTP client are imported where they
+# are used, so --page-map / --dry-run start without them.
 from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
 from reportlab.lib.units import cm
 from reportlab.lib import colors
-from reportlab.platypus import Paragraph, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-import os, textwrap, re, math, requests
+from reportlab.pdfbase import pdfmetrics
+import os, re, math, json, time, hashlib, threading, tempfile
+from collections import namedtuple
+from functools import lru_cache
+from itertools import accumulate
+from operator import add
+from bisect import bisect_right
+from image_cache import CACHE_ROOT, file_lock, is_url, prefetch_images, prepare_images, replace_file
+from question_bank import QuestionIndex, filter_questions, open_bank, sort_questions
+from output_cache import OutputCache, DEFAULT_OUTPUT_CACHE_DIR
+from instrument import instr
+from fonts import font_roles, load_font, load_all_fonts, seed_subsets
+from dedup import dedup_questions
+
+# faces resolved once per process (TTF with full glyph coverage when installed)
+_fonts = font_roles()
+FONT_SANS = _fonts["sans"]
+FONT_BOLD = _fonts["sans_bold"]
+FONT_ITALIC = _fonts["sans_italic"]
+FONT_SERIF_BOLD = _fonts["serif_bold"]
 
 DEFAULT_SKETCH_H = 7.0 * cm  # default sketch box height
-
-# -------------------------
-# Debug helper (uses canvas page number)
-# -------------------------
-def dbg(msg):
-    try:
-        print(f"DEBUG [page {c.getPageNumber()}]: {msg}")
-    except Exception:
-        print("DEBUG [page ?:]", msg)
+IMAGE_BOX_W, IMAGE_BOX_H = 7.0 * cm, 4.0 * cm  # every part figure is fitted into this box
 
 # -------------------------
 # Questions (sample; add `end_of_topic: True` to final Q of each topic)
 # -------------------------
-questions = [
+SAMPLE_QUESTIONS = [
     # ---------------- Topic: Electricity and Magnetism ----------------
     {
         "chapter_title": "Electricity and Magnetism",
@@ -164,8 +176,8 @@ Describe the experiment and how the data is used. [5]""",
 # -------------------------
 # Output
 # -------------------------
-output_filename = "Topical_Booklet_with_end_of_topic_fixed.pdf"
-filepath = os.path.join(os.getcwd(), output_filename)
+DEFAULT_OUTPUT_FILENAME = "Topical_Booklet_with_end_of_topic_fixed.pdf"
+DEFAULT_TITLE = "Physics — Topical Past Papers"
 
 # -------------------------
 # Helpers (same as before)
@@ -177,6 +189,7 @@ def superscript_digits(s):
     s = re.sub(r'×10\^(\d+)', lambda m: '×10' + ''.join(ch.translate(sup_map) for ch in m.group(1)), s)
     return s
 
+@lru_cache(maxsize=65536)
 def tidy_text_for_math(text):
     if not text:
         return ""
@@ -184,7 +197,138 @@ def tidy_text_for_math(text):
     text = text.replace('x10^', '×10^')
     return superscript_digits(text)
 
-def wrapped_lines(text, max_chars):
+@lru_cache(maxsize=65536)
+def word_width(word, font, size):
+    """Rendered width of a word in points (cached per word, font and size)."""
+    load_font(font)
+    return pdfmetrics.stringWidth(word, font, size)
+
+def _break_long_word(word, font, size, max_width):
+    # split a word wider than the line into chunks that fit (like textwrap's break_long_words)
+    chunks, cur = [], ""
+    for ch in word:
+        if cur and word_width(cur + ch, font, size) > max_width:
+            chunks.append(cur)
+            cur = ch
+        else:
+            cur += ch
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+def wrap_to_width(para, font, size, max_width):
+    """Greedy word wrap of one paragraph to max_width points using real font metrics."""
+    lines, cur, cur_w = [], [], 0.0
+    space = word_width(" ", font, size)
+    for word in para.split():
+        w = word_width(word, font, size)
+        if w > max_width:
+            if cur:
+                lines.append(" ".join(cur))
+            *full, last = _break_long_word(word, font, size, max_width)
+            lines.extend(full)
+            cur, cur_w = [last], word_width(last, font, size)
+        elif cur and cur_w + space + w > max_width:
+            lines.append(" ".join(cur))
+            cur, cur_w = [word], w
+        else:
+            cur_w = cur_w + space + w if cur else w
+            cur.append(word)
+    if cur:
+        lines.append(" ".join(cur))
+    return lines
+
+# Line breaking of a plain-text reportlab Paragraph (Paragraph.breakLines, single
+# font), used to measure table cells without importing platypus.  Besides
+# wrapping at spaces it lets a line run spaceShrinkage of a space per word past
+# the width, splits an over-long word character by character starting on the
+# current line, and with embeddedHyphenation breaks a word after one of its own
+# hyphens ("half-|life").  Inline markup is not parsed.
+_HY_LETTERS = "A-Za-z\xc0-\xd6\xd8-\xf6\xf8-\u024f\u1e80-\u1e85\u1e00-\u1eff\u0410-\u044f"
+_HY_SPLIT_RE = re.compile("([-\xad])")
+_HY_WORD_RE = re.compile(f"^[-\xad{_HY_LETTERS}]+$")
+_HY_PREFIX_RE = re.compile("^['\"(\\[{\xbf\u2018\u201a\u201c\u201e]+")
+_HY_SUFFIX_RE = re.compile("[\\]'\")}?!.,;:\u2019\u201b\u201d\u201f]+$")
+
+@lru_cache(maxsize=None)
+def _paragraph_rules():
+    from reportlab import rl_config
+    return rl_config.spaceShrinkage, rl_config.embeddedHyphenation, rl_config.hyphenationMinWordLength
+
+def _hyphen_split(word, start_w, max_width, font, size, min_len):
+    # (head, tail) at the last embedded hyphen whose head fits after start_w
+    pfx = _HY_PREFIX_RE.match(word)
+    pfx = pfx.group(0) if pfx else ""
+    core = word[len(pfx):]
+    sfx = _HY_SUFFIX_RE.search(core)
+    sfx = sfx.group(0) if sfx else ""
+    core = core[:len(core) - len(sfx)]
+    if len(core) < min_len:
+        return None
+    pieces = _HY_SPLIT_RE.split(core)
+    if len(pieces) < 3 or "" in pieces or not _HY_WORD_RE.match(core):
+        return None
+    for i in range(len(pieces) - 1 - (len(pieces) - 1) % 2, 1, -2):
+        head = pfx + "".join(pieces[:i])
+        if start_w + word_width(head, font, size) <= max_width:
+            return head, "".join(pieces[i:]) + sfx
+    return None
+
+def _split_word_chars(word, line_w, max_width, font, size):
+    pieces, cur = [], ""
+    for ch in word:
+        cw = word_width(ch, font, size)
+        if line_w + cw > max_width and (cur or cw <= max_width):
+            pieces.append((cur, "split"))
+            line_w, cur = cw, ""
+        else:
+            line_w += cw
+        cur += ch
+    pieces.append((cur, "end"))
+    return pieces
+
+@lru_cache(maxsize=1 << 17)
+def paragraph_line_count(text, font, size, max_width):
+    """Lines a plain-text Paragraph in font/size breaks text into at max_width."""
+    words = text.split()
+    if not words:
+        return 0
+    space = word_width(" ", font, size)
+    if sum(word_width(w, font, size) for w in words) + space * (len(words) - 1) <= max_width:
+        return 1   # the common case: a short answer
+    shrink, hyphenate, min_len = _paragraph_rules()
+    queue = [(w, None) for w in reversed(words)]
+    lines, n, cur_w, forced = 0, 0, -space, False
+    while queue:
+        word, kind = queue.pop()
+        if not word and kind:
+            forced = True
+        w = word_width(word, font, size)
+        new_w = cur_w + space + w
+        limit = max_width + shrink * space * n
+        if new_w > limit and not (kind == "head" or forced):
+            pair = _hyphen_split(word, cur_w + space, limit, font, size, min_len) if hyphenate else None
+            if pair:
+                queue += [(pair[1], "end"), (pair[0], "head")]
+                forced = True
+                continue
+            if not kind and w > max_width:
+                queue += reversed(_split_word_chars(word, cur_w + space, max_width, font, size))
+                forced = True
+                continue
+        if new_w <= limit or not n or forced:
+            n += bool(word)
+            if forced:
+                lines += 1
+                n, cur_w, forced = 0, -space, False
+            else:
+                cur_w = new_w
+        else:
+            lines += 1
+            n, cur_w = 1, w
+    return lines + bool(n)
+
+def wrapped_lines(text, max_width, font=FONT_SANS, size=10.5):
     out = []
     if text is None:
         return out
@@ -193,7 +337,7 @@ def wrapped_lines(text, max_chars):
         if not para:
             out.append("")
             continue
-        wrap_lines = textwrap.wrap(para, width=max_chars)
+        wrap_lines = wrap_to_width(para, font, size, max_width)
         if not wrap_lines:
             out.append("")
         else:
@@ -201,31 +345,118 @@ def wrapped_lines(text, max_chars):
         out.append("")
     return out
 
-def download_image(url, filename):
-    if not url:
-        return None
-    if os.path.exists(url):
-        return url
-    try:
-        if not os.path.exists(filename):
-            r = requests.get(url, stream=True, timeout=15)
-            r.raise_for_status()
-            with open(filename, "wb") as f:
-                for chunk in r.iter_content(1024):
-                    f.write(chunk)
-        return filename
-    except Exception as e:
-        print("Image download error:", e)
-        return None
+LINES_PER_MARK = 1.7   # answer lines reserved per mark
 
 def lines_per_marks(marks):
-    return int(math.ceil(1.7 * (marks or 0))) if marks and marks > 0 else 3
+    return int(math.ceil(LINES_PER_MARK * (marks or 0))) if marks and marks > 0 else 3
+
+# -------------------------
+# Question parse cache
+# -------------------------
+# Each question text is tidied, split into parts and wrapped once; the layout
+# engine and the marking-scheme builder both read the same ParsedQuestion.
+# Entries are keyed by a hash of the raw question text, so identical texts
+# (across topics, booklets or runs) share one parse.
+#
+# parts: every block after the intro.  label is None for a block that doesn't
+# start with "(x)"; marks is the first "[n]" in the part body, or None.
+ParsedQuestion = namedtuple("ParsedQuestion", "text has_parts intro_lines parts")
+ParsedPart = namedtuple("ParsedPart", "label body marks lines")
+
+# bump the number when parsing or wrapping rules change, to invalidate saved caches;
+# the body font is part of it because it sets the wrapped line breaks
+PARSE_VERSION = "2:" + FONT_SANS
+_parse_memo = {}
+_parse_unsaved = set()   # keys parsed since the parse cache was last saved
+_parse_lock = threading.Lock()
+
+def _parse_key(raw):
+    return hashlib.blake2b((PARSE_VERSION + raw).encode("utf-8"), digest_size=16).hexdigest()
+
+def _parse_question_text(raw):
+    text = tidy_text_for_math(raw)
+    blocks = re.split(r'(?=\([a-z]\))', text, flags=re.IGNORECASE)
+    if len(blocks) == 1:
+        return ParsedQuestion(text, False, wrapped_lines(blocks[0], body_wrap_width), [])
+    intro = blocks[0].strip()
+    intro_lines = wrapped_lines(intro, body_wrap_width) if intro else []
+    parts = []
+    for block in blocks[1:]:
+        if not block.strip():
+            continue
+        m = re.match(r'\(([a-z])\)\s*(.*)', block.strip(), re.S | re.IGNORECASE)
+        if not m:
+            parts.append(ParsedPart(None, block, None, wrapped_lines(block, body_wrap_width)))
+            continue
+        body = m.group(2).strip()
+        mmarks = re.search(r'\[(\d+)\]', body)
+        parts.append(ParsedPart(m.group(1).lower(), body, int(mmarks.group(1)) if mmarks else None,
+                                wrapped_lines(body, part_wrap_width)))
+    return ParsedQuestion(text, True, intro_lines, parts)
+
+def parse_question(q):
+    """Return the (memoized) ParsedQuestion for a question record."""
+    raw = q.question_text or ""
+    key = _parse_key(raw)
+    parsed = _parse_memo.get(key)
+    if parsed is None:
+        parsed = _parse_question_text(raw)
+        with _parse_lock:
+            _parse_memo[key] = parsed
+            _parse_unsaved.add(key)
+    return parsed
+
+def load_parse_cache(path):
+    """Merge a parse cache saved by save_parse_cache() into this process's memo."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    if saved.get("version") != PARSE_VERSION:
+        return 0
+    entries = {}
+    for key, (text, has_parts, intro_lines, parts) in saved["entries"].items():
+        entries[key] = ParsedQuestion(text, has_parts, intro_lines, [ParsedPart(*p) for p in parts])
+    with _parse_lock:
+        for key, parsed in entries.items():
+            _parse_memo.setdefault(key, parsed)
+    return len(entries)
+
+def save_parse_cache(path):
+    """Write the memo to path if anything was parsed since the last save.
+
+    Entries on disk are kept: other processes (batch workers) may have saved
+    questions this one never saw, so the file is re-read and merged under a
+    lock before it is replaced.
+    """
+    with _parse_lock:
+        if not _parse_unsaved:
+            return False
+        _parse_unsaved.clear()
+    with file_lock(path):
+        entries = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("version") == PARSE_VERSION:
+                entries = saved["entries"]
+        except (OSError, ValueError):
+            pass
+        with _parse_lock:
+            entries.update(_parse_memo)
+            data = json.dumps({"version": PARSE_VERSION, "entries": entries}, ensure_ascii=False)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+        replace_file(tmp, path)
+    return True
 # -------------------------
 # Sketch helpers (new, small & local)
 # -------------------------
 def _get_part_sketch_height(q, label):
     """Always return fixed sketch height if part needs a sketch."""
-    spec = q.get("sketch")
+    spec = q.sketch
     if isinstance(spec, dict):
         if spec.get(label):
             return DEFAULT_SKETCH_H
@@ -236,7 +467,7 @@ def _get_part_sketch_height(q, label):
 
 def _is_part_sketch_only(q, label):
     """Return True if this part should be sketch-only (no answer lines)."""
-    spec = q.get("sketch_only")
+    spec = q.sketch_only
     if isinstance(spec, dict):
         return bool(spec.get(label))
     # If sketch_only is a truthy non-dict value, apply to all parts/whole
@@ -244,7 +475,7 @@ def _is_part_sketch_only(q, label):
 
 def _get_whole_sketch_height(q):
     """Always return fixed sketch height if whole-question sketch requested."""
-    spec = q.get("sketch")
+    spec = q.sketch
     if isinstance(spec, dict):
         if spec.get("whole"):
             return DEFAULT_SKETCH_H
@@ -255,7 +486,7 @@ def _get_whole_sketch_height(q):
 
 def _is_whole_sketch_only(q):
     """Return True if whole-question sketch_only is set."""
-    spec = q.get("sketch_only")
+    spec = q.sketch_only
     if isinstance(spec, dict):
         return bool(spec.get("whole"))
     return bool(spec)
@@ -264,9 +495,7 @@ def _is_whole_sketch_only(q):
 # -------------------------
 # PDF setup
 # -------------------------
-c = canvas.Canvas(filepath, pagesize=A4)
 width, height = A4
-page_has_content = False
 
 left_margin = 2 * cm
 right_margin = 2 * cm
@@ -275,715 +504,1738 @@ bottom_margin = 2.0 * cm
 gutter_x = left_margin
 text_x = gutter_x + 25
 line_height = 13
-styles = getSampleStyleSheet()
-normal_style = ParagraphStyle("normal", parent=styles["Normal"], fontName="Helvetica", fontSize=10, leading=12)
-toc_entry_style = ParagraphStyle("toc_entry", parent=styles["Normal"], fontName="Helvetica", fontSize=12, leading=14)
-toc_header_style = ParagraphStyle("toc_header", parent=styles["Normal"], fontName="Helvetica-Bold", fontSize=14, leading=16)
 content_width = width - left_margin - right_margin
+_grid_table_style = [
+    ("BACKGROUND", (0,0), (-1,0), colors.lightgrey),
+    ("VALIGN", (0,0), (-1,-1), "TOP"),
+    ("GRID", (0,0), (-1,-1), 0.5, colors.black),
+    ("RIGHTPADDING", (0,0), (-1,-1), 6),
+    ("TOPPADDING", (0,0), (-1,-1), 6),
+    ("BOTTOMPADDING", (0,0), (-1,-1), 6),
+]
+TableStyles = namedtuple("TableStyles", "normal toc_entry toc_header toc_table ms_table")
+
+@lru_cache(maxsize=None)
+def table_styles():
+    """Paragraph and table styles, built on first use and shared by every booklet in the process."""
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import TableStyle
+    load_all_fonts()
+    normal = getSampleStyleSheet()["Normal"]
+    return TableStyles(
+        normal=ParagraphStyle("normal", parent=normal, fontName=FONT_SANS, fontSize=10, leading=12),
+        toc_entry=ParagraphStyle("toc_entry", parent=normal, fontName=FONT_SANS, fontSize=12, leading=14),
+        toc_header=ParagraphStyle("toc_header", parent=normal, fontName=FONT_BOLD, fontSize=14, leading=16),
+        toc_table=TableStyle(_grid_table_style + [
+            ("FONT", (0,0), (-1,0), FONT_BOLD, 14),
+            ("ALIGN", (0,0), (-1,-1), "LEFT"),
+            ("LEFTPADDING", (0,0), (-1,-1), 8),
+        ]),
+        ms_table=TableStyle(_grid_table_style + [
+            ("FONT", (0,0), (-1,0), FONT_BOLD, 10),
+            ("FONT", (0,1), (2,-1), FONT_SANS, 10),
+            ("LEFTPADDING", (0,0), (-1,-1), 6),
+        ]),
+    )
+# question text is wrapped to the real 10.5pt body-font width between its x position and the right margin
+body_wrap_width = width - right_margin - text_x
+part_wrap_width = width - right_margin - (text_x + 12)
 
-# normalize images_for_parts
-for q in questions:
-    image_field = q.get("image")
-    if isinstance(image_field, dict):
-        q["_images_for_parts"] = image_field
-    else:
-        q["_images_for_parts"] = {"b": image_field} if image_field else {}
+# -------------------------
+# Question records
+# -------------------------
+# Records are loaded into slotted Question objects once per build.  The sketch,
+# sketch_only and image specs (each either one value for the whole question or
+# a {label: value} dict) are resolved here, so the layout reads plain attributes
+# instead of re-checking the raw dicts for every part of every question.
+RECORD_FIELDS = ("chapter_title", "exam_series", "subject", "original_ref", "question_number", "marks",
+                 "question_text", "answer_text", "end_of_topic", "sketch", "sketch_only", "image")
+
+class Part:
+    """One part of a question: its parsed text plus this question's flags for it."""
+    __slots__ = ("label", "body", "marks", "lines", "body_count", "image", "sketch_h", "sketch_only",
+                 "answer_lines")
+
+    def __init__(self, parsed_part, q):
+        self.label = label = parsed_part.label
+        self.body = parsed_part.body
+        self.marks = parsed_part.marks
+        self.lines = parsed_part.lines
+        self.body_count = len(self.lines) - self.lines.count("")
+        self.image = q.images_for_parts.get(label) if label else None
+        self.sketch_h = _get_part_sketch_height(q, label)
+        self.sketch_only = _is_part_sketch_only(q, label)
+        # sketch-only parts get no answer lines after the sketch
+        self.answer_lines = 0 if self.sketch_only else lines_per_marks(self.marks or 0)
+
+class Question:
+    """A question record with its layout flags resolved at load time."""
+    __slots__ = RECORD_FIELDS + ("ident", "images_for_parts", "whole_sketch_h", "whole_sketch_only",
+                                 "answer_lines", "_parts")
+
+    def __init__(self, record):
+        get = record.get
+        for field in RECORD_FIELDS:
+            setattr(self, field, get(field))
+        self.marks = get("marks", 0)
+        self.answer_text = get("answer_text") or {}
+        self.ident = f"{get('exam_series', '')} | {get('subject', '')} | {get('original_ref', '')}"
+        if isinstance(self.image, dict):
+            self.images_for_parts = self.image
+        else:
+            self.images_for_parts = {"b": self.image} if self.image else {}
+        self.whole_sketch_h = _get_whole_sketch_height(self)
+        self.whole_sketch_only = _is_whole_sketch_only(self)
+        self.answer_lines = 0 if self.whole_sketch_only else lines_per_marks(self.marks)
+        self._parts = None
+
+    @property
+    def parts(self):
+        """Parts of the parsed text, with per-part flags (resolved on first use)."""
+        if self._parts is None:
+            self._parts = tuple(Part(p, self) for p in parse_question(self).parts)
+        return self._parts
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in RECORD_FIELDS if getattr(self, field) is not None}
+
+def normalize_questions(questions):
+    """Load records into Question objects (Questions are passed through).
+
+    The caller's dicts are left untouched so one question list can be shared
+    between builds.
+    """
+    return [q if isinstance(q, Question) else Question(q) for q in questions]
 
 # -------------------------
-# Page helpers
+# Paragraph layout cache
 # -------------------------
-# ---------- Page helpers (simplified & deterministic) ----------
-def finish_page(start_new=True, footer_text=None, force=False):
-    """Draw footer and page number then (usually) start a new page.
+# The same answers recur across topics and across the booklets of a batch, so
+# answer cells are shared Paragraph objects that keep their line breaks: a
+# Paragraph is built and broken into lines once per (text, style, width) and
+# every later table (and every Table.split piece) reuses it.  reportlab sets
+# and deletes para.canv while drawing, so a Paragraph is only shared within one
+# thread: each thread has its own cache.
+PARAGRAPH_CACHE_SIZE = 20000
+_paragraph_local = threading.local()
+
+@lru_cache(maxsize=None)
+def _wrapped_paragraph_class():
+    from reportlab.platypus import Paragraph
+
+    class _WrappedParagraph(Paragraph):
+        """Paragraph that only re-breaks its lines when wrapped at a new width."""
+        _wrapped_at = None
+
+        def wrap(self, availWidth, availHeight):
+            if availWidth != self._wrapped_at:
+                self._wrapped_size = Paragraph.wrap(self, availWidth, availHeight)
+                self._wrapped_at = availWidth
+            return self._wrapped_size
+
+    _WrappedParagraph.__qualname__ = "_WrappedParagraph"
+    return _WrappedParagraph
+
+def __getattr__(name):
+    # lets pickle find the lazily created class (render_parallel ships MS tables to workers)
+    if name == "_WrappedParagraph":
+        return _wrapped_paragraph_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def cached_paragraph(text, style, width):
+    """Paragraph for text in style, for a cell of the given width, shared by this
+    thread's tables (LRU-bounded)."""
+    cache = getattr(_paragraph_local, "cache", None)
+    if cache is None:
+        cache = _paragraph_local.cache = lru_cache(maxsize=PARAGRAPH_CACHE_SIZE)(
+            lambda text, style, width: _wrapped_paragraph_class()(text, style))
+    return cache(text, style, width)
 
-    - If start_new True we WILL call showPage() unless:
-        * start_new==True and force==False and page_has_content==False:
-          -> we will NOT create a new page (this preserves earlier small optimization).
-    - For clarity: whenever you *must* advance to a fresh page (divider, end_of_topic),
-      call finish_page(start_new=True, force=True).
+# -------------------------
+# Table builders (TOC + marking scheme)
+# -------------------------
+def build_toc_table(title, rows):
+    """rows: list of (topic, page) pairs."""
+    from reportlab.platypus import Paragraph, Table
+    st = table_styles()
+    tbl_rows = [[Paragraph(f'<b>{title}</b>', st.toc_header), Paragraph('<b>Page</b>', st.toc_header)]]
+    for topic, page in rows:
+        tbl_rows.append([Paragraph(topic, st.toc_entry), Paragraph(str(page), st.toc_entry)])
+    tbl = Table(tbl_rows, colWidths=[content_width - 3.0*cm, 3.0*cm])
+    tbl.setStyle(st.toc_table)
+    return tbl
+
+def build_ms_table(topic_questions):
+    # Build table rows with Marks column. Single-block questions: Part = "-", Marks = total.
+    from reportlab.platypus import Table
+    st = table_styles()
+    col_widths = [2.0*cm, 2.0*cm, 2.0*cm, content_width - 6.0*cm]
+    table_rows = [["Question", "Part", "Marks", "Answer"]]
+    for q in topic_questions:
+        parsed = parse_question(q)
+        if not parsed.has_parts:
+            # single-block question -> single row with Part = "-" and Marks = question marks
+            ans_text = tidy_text_for_math(next(iter(q.answer_text.values()), ""))
+            para = cached_paragraph(ans_text, st.normal, col_widths[3])
+            table_rows.append([f"{q.question_number}", "-", f"{q.marks}", para])
+        else:
+            # question has parts -> list each part on its own row with the marks parsed from its body
+            part_marks = {p.label: p.marks for p in parsed.parts if p.label}
+            first_row = True
+            for part_key in sorted(q.answer_text.keys()):
+                ans = tidy_text_for_math(q.answer_text[part_key])
+                para = cached_paragraph(ans, st.normal, col_widths[3])
+                marks_part = part_marks.get(part_key.lower())
+                if marks_part is None:
+                    marks_part = "-"
+                if first_row:
+                    table_rows.append([f"{q.question_number}", f"({part_key})", marks_part, para])
+                    first_row = False
+                else:
+                    table_rows.append(["", f"({part_key})", marks_part, para])
+
+    tbl = Table(table_rows, colWidths=col_widths, repeatRows=1)
+    tbl.setStyle(st.ms_table)
+    return tbl
+
+# room for an MS table below its topic heading, keeping a 20pt gap above the footer
+ms_avail_height = height - top_margin - 56 - bottom_margin - 20
+
+def split_ms_table(tbl, avail=ms_avail_height):
+    """Cut an MS table into page-sized pieces; returns [(table, height), ...].
+
+    Table.split repeats the header row (repeatRows=1) on every piece.  Each piece
+    is wrapped exactly once here and the layout reuses that height, so nothing
+    is re-wrapped after a page break.  A single row taller than a page cannot be
+    split and is left to overflow, as before.
     """
-    global page_has_content
+    pieces = []
+    while True:
+        _, h = tbl.wrap(content_width, avail)
+        if h <= avail:
+            pieces.append((tbl, h))
+            return pieces
+        parts = tbl.split(content_width, avail)
+        if len(parts) < 2:
+            pieces.append((tbl, h))
+            return pieces
+        head, tbl = parts[0], parts[1]
+        pieces.append((head, head.wrap(content_width, avail)[1]))
+
+def ms_table_key(topic_questions):
+    """Content key for a topic's MS table (everything build_ms_table reads)."""
+    rows = [(q.question_number, q.marks, q.question_text, q.answer_text) for q in topic_questions]
+    data = json.dumps([PARSE_VERSION, rows], sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+def _image_is_drawable(path):
+    """Cheap header read so the layout only reserves space for images drawImage can use."""
+    from reportlab.lib.utils import ImageReader
     try:
-        # draw footer & page number only if anything was drawn (or if user wants footer anyway)
-        if page_has_content or footer_text:
-            c.setFont("Helvetica", 8)
-            c.setFillColor(colors.grey)
-            ft = footer_text or ""
-            c.drawString(left_margin, bottom_margin - 14, ft)
-            c.setFillColor(colors.black)
-            c.setFont("Helvetica-Bold", 11)
-            c.drawRightString(width - right_margin, bottom_margin - 10, str(c.getPageNumber()))
-            dbg("Finishing page (with content/footer)")
+        ImageReader(path).getSize()
+        return True
+    except Exception:
+        return False
+
+# -------------------------
+# Layout engine (single pass)
+# -------------------------
+# The booklet is measured exactly once.  LayoutEngine walks the questions with the
+# pagination rules below and records every placed block on its page; render_layout()
+# only replays those blocks, and the TOC reads its page numbers from the same pages.
+#
+# Blocks are plain tuples:
+#   ("text", x, y, string, font, size, align, color)    align: "left" | "right" | "centre"
+#   ("line", x1, y1, x2, y2, color, line_width, dash)   dash: () for solid
+#   ("image", path, x, y, w, h)
+#   ("flowable", flowable, x, y, key)                   already wrapped at layout time; key identifies its content
+#   ("page_number", x, y, string, font, size)           right-aligned footer number
+#   ("form", template, arg, x, y)                       page template (see PAGE_TEMPLATES) with its origin at x, y
+
+class Page:
+    def __init__(self, number):
+        self.number = number
+        self.blocks = []
+        self.has_content = False
+        self.flushed = False   # blocks already rendered and released (streaming builds)
+
+class BookletLayout:
+    """Pages with their placed blocks, plus the page map used by the TOC."""
+    def __init__(self):
+        self.pages = [Page(1)]
+        self.topic_divider_pages = {}
+        self.topic_ms_start_pages = {}
+        self.ms_divider_page = None
+
+    @property
+    def page(self):
+        return self.pages[-1]
+
+    @property
+    def emitted_pages(self):
+        # a trailing page with nothing placed on it is never written (canvas.save() skips it)
+        if len(self.pages) > 1 and not self.pages[-1].blocks and not self.pages[-1].flushed:
+            return self.pages[:-1]
+        return self.pages
+
+    @property
+    def page_count(self):
+        return len(self.emitted_pages)
+
+    def page_map(self):
+        return {
+            "topic_divider_pages": self.topic_divider_pages,
+            "topic_ms_start_pages": self.topic_ms_start_pages,
+            "ms_divider_page": self.ms_divider_page,
+            "page_count": self.page_count,
+        }
+
+    @classmethod
+    def from_page_map(cls, page_map):
+        """A layout holding only the page map (e.g. for a booklet served from the output cache)."""
+        layout = cls()
+        layout.topic_divider_pages = dict(page_map["topic_divider_pages"])
+        layout.topic_ms_start_pages = dict(page_map["topic_ms_start_pages"])
+        layout.ms_divider_page = page_map["ms_divider_page"]
+        layout.pages = [Page(n) for n in range(1, page_map["page_count"] + 1)]
+        for page in layout.pages:
+            page.flushed = True
+        return layout
+
+
+class LayoutEngine:
+    def __init__(self, images=None):
+        self.layout = BookletLayout()
+        # image reference -> local path (or None), resolved by the prefetch stage
+        self.images = images or {}
+
+    # ---------- block placement ----------
+    def _text(self, x, y, s, font, size, align="left", color=colors.black, content=True):
+        page = self.layout.page
+        page.blocks.append(("text", x, y, s, font, size, align, color))
+        if content:
+            page.has_content = True
+
+    def _line(self, x1, y1, x2, y2, color, line_width, dash=(), content=True):
+        page = self.layout.page
+        page.blocks.append(("line", x1, y1, x2, y2, color, line_width, dash))
+        if content:
+            page.has_content = True
+
+    def _block(self, block):
+        page = self.layout.page
+        page.blocks.append(block)
+        page.has_content = True
+
+    def _form(self, template, arg, x, y, content=True):
+        page = self.layout.page
+        page.blocks.append(("form", template, arg, x, y))
+        if content:
+            page.has_content = True
+
+    def _header(self, header_text=None):
+        # header alone is not 'content'
+        if header_text:
+            self._text(width/2.0, height - top_margin + 6, header_text, FONT_BOLD, 9, align="centre", content=False)
+        self._form("header_rule", None, left_margin, height - top_margin - 2, content=False)
+
+    # ---------- page helpers (simplified & deterministic) ----------
+    def finish_page(self, start_new=True, footer_text=None, force=False):
+        """Place footer and page number then (usually) start a new page.
+
+        - If start_new True we WILL start a new page unless:
+            * start_new==True and force==False and the page has no content:
+              -> we will NOT create a new page (this preserves earlier small optimization).
+        - For clarity: whenever you *must* advance to a fresh page (divider, end_of_topic),
+          call finish_page(start_new=True, force=True).
+        """
+        page = self.layout.page
+        if page.has_content or footer_text:
+            if footer_text:
+                self._text(left_margin, bottom_margin - 14, footer_text, FONT_SANS, 8, color=colors.grey, content=False)
+            page.blocks.append(("page_number", width - right_margin, bottom_margin - 10, str(page.number),
+                                FONT_BOLD, 11))
+            if instr.debug_on:
+                instr.debug("Finishing page (with content/footer)", page.number)
         else:
-            dbg("Finishing page (no content & no footer)")
+            if instr.debug_on:
+                instr.debug("Finishing page (no content & no footer)", page.number)
+
+        new_page = start_new and (page.has_content or force)
+        # reset content flag on the current page; a new page always starts empty
+        page.has_content = False
+        if new_page:
+            self.layout.pages.append(Page(page.number + 1))
+            if instr.debug_on:
+                instr.debug("start_new -> new page", page.number)
+        elif start_new:
+            if instr.debug_on:
+                instr.debug("start_new requested but page empty & force==False -> skipping new page", page.number)
+
+    def start_new_page(self, header_text=None):
+        """Finish the current page and start a fresh one with header placed.
+           This *forces* a new page even if current page had no content.
+        """
+        self.finish_page(start_new=True, force=True)
+        self._header(header_text)
+        return height - top_margin - 36
+
+    def ensure_space(self, y, needed_h):
+        if y - needed_h < bottom_margin + 20:
+            return self.start_new_page(None)
+        return y
+
+    # ---------- front matter ----------
+    def place_front_page(self, title=DEFAULT_TITLE):
+        self._text(width/2, height/2 + 40, title, FONT_SERIF_BOLD, 22, align="centre")
+        self._text(width/2, height/2 + 15, "Compiled booklet", FONT_SANS, 12, align="centre")
+        self.finish_page(start_new=True)
+
+    def place_toc(self, topics):
+        """Place both TOC tables; they are measured with placeholder page numbers and
+        swapped for the real ones in finalize_toc() once the body has been laid out."""
+        tbl_x = left_margin
+        tp_tbl = build_toc_table("Topical Past Papers", [(t, "000") for t in topics])
+        t_w, t_h = tp_tbl.wrap(content_width, height)
+        tbl_y = height - top_margin - 40 - t_h
+        if tbl_y < bottom_margin:
+            self.finish_page(start_new=True)
+            tbl_y = height - top_margin - 40 - t_h
+        self._toc_slots = [(self.layout.page, len(self.layout.page.blocks), "Topical Past Papers",
+                            self.layout.topic_divider_pages)]
+        self._block(("flowable", tp_tbl, tbl_x, tbl_y, "toc"))
+
+        # Keep the topical TOC table and the MS TOC table on the same page.
+        # Do NOT force a page break here. Instead draw the MS TOC below if it fits.
+        gap_after = 18
+        y_after = tbl_y - gap_after
+
+        ms_tbl = build_toc_table("Marking Scheme", [(t, "000") for t in topics])
+        m_w, m_h = ms_tbl.wrap(content_width, height)
+        tbl2_y = y_after - m_h
+        if tbl2_y < bottom_margin:
+            # if it doesn't fit, then force a new page and draw the MS TOC there
+            self.finish_page(start_new=True)
+            tbl2_y = height - top_margin - 40 - m_h
+        self._toc_slots.append((self.layout.page, len(self.layout.page.blocks), "Marking Scheme",
+                                self.layout.topic_ms_start_pages))
+        self._block(("flowable", ms_tbl, tbl_x, tbl2_y, "toc"))
+
+        # Only force a fresh page after both TOC tables are drawn, so the first topic divider starts on a clean page.
+        self.finish_page(start_new=True, force=True)
+
+    def finalize_toc(self, topics):
+        for page, idx, title, page_map in self._toc_slots:
+            _, _, x, y, key = page.blocks[idx]
+            tbl = build_toc_table(title, [(t, page_map.get(t, '')) for t in topics])
+            tbl.wrap(content_width, height)
+            page.blocks[idx] = ("flowable", tbl, x, y, key)
+
+    # ---------- topical content ----------
+    def place_topic_divider(self, title):
+        self._text(width/2, height/2 + 20, title, FONT_SERIF_BOLD, 20, align="centre")
+        self._text(width/2, height/2 - 6, "Topical Past Papers", FONT_SANS, 13, align="centre")
+        self.layout.topic_divider_pages[title] = self.layout.page.number
+        # finish the divider page and force a new page for the questions (divider must be alone)
+        self.finish_page(start_new=True, force=True)
+        self._header()
+        return height - top_margin - 36
+
+    def _question_number(self, q, y):
+        self._text(gutter_x - 12, y, str(q.question_number if q.question_number is not None else ""), FONT_BOLD, 11)  # shift left by 12 pts
+
+    def _sketch_box(self, y, sketch_h):
+        rect_top = y
+        rect_bottom = y - sketch_h
+        if rect_bottom < bottom_margin + 20:
+            y = self.start_new_page(None)
+            rect_top = y
+            rect_bottom = y - sketch_h
+        # clean sketch area (no dashed box, just top & bottom lines)
+        self._form("sketch_box", sketch_h, text_x, rect_top)
+        return rect_bottom - 24
+
+    def _answer_lines(self, y, count):
+        # the lines that land on one page are placed as a single answer_lines grid
+        run_y, run = y, 0
+        for i in range(count):
+            if y < bottom_margin + 20:
+                if run:
+                    self._form("answer_lines", run, text_x, run_y)
+                y = run_y = self.start_new_page(None)
+                run = 0
+            run += 1
+            y -= (line_height + 2)
+        if run:
+            self._form("answer_lines", run, text_x, run_y)
+        return y - 8
+
+    def place_question(self, q, y):
+        if instr.debug_on:
+            instr.debug(f"Start question {q.question_number} ({q.chapter_title}) at y={y}", self.layout.page.number)
+        self.layout.page.has_content = True
+        y = self.ensure_space(y, 36)
+        self._text(left_margin, y, q.ident, FONT_ITALIC, 8.5)
+        y -= 16
+
+        parsed = parse_question(q)
+        printed_number = False
+        last_text_line_y = None
 
-        # Decision to actually create a new page:
-        if start_new:
-            if page_has_content or force:
-                c.showPage()
-                dbg("start_new -> showPage() called")
-            else:
-                dbg("start_new requested but page empty & force==False -> skipping showPage()")
-        # reset content flag on the new current page
-        page_has_content = False
-    except Exception as e:
-        dbg(f"finish_page exception: {e}")
-        # fallback: try to show a new page to keep running
-        if start_new:
-            c.showPage()
-            page_has_content = False
-
-def start_new_page(header_text=None):
-    """Convenience: finish current page (if necessary) and start a fresh page with header drawn.
-       This *forces* a new page even if current page had no content.
-       Use this when you want an absolutely clean page for the next section.
-    """
-    # force break from whatever we're on
-    finish_page(start_new=True, force=True)
-    dbg("New (forced) page started")
-    # draw header on the new page (header doesn't mark the page as content)
-    if header_text:
-        c.setFont("Helvetica-Bold", 9)
-        c.drawCentredString(width/2.0, height - top_margin + 6, header_text)
-    else:
-        c.setFont("Helvetica-Bold", 9)
-        c.drawCentredString(width/2.0, height - top_margin + 6, "")
-    c.setLineWidth(0.4)
-    c.setStrokeColor(colors.grey)
-    c.line(left_margin, height - top_margin - 2, width - right_margin, height - top_margin - 2)
-    c.setStrokeColor(colors.black)
-    # header alone is not 'content'; leave page_has_content False
-    return height - top_margin - 36
-
-# -------------------------
-# Build topic order
-# -------------------------
-topics_in_order = list(dict.fromkeys(q["chapter_title"] for q in questions))
-
-# -------------------------
-# SIMULATION PASS (uses end_of_topic to predict divider pages)
-# -------------------------
-def simulate_layout(questions, topics):
-    """Return (topic_divider_pages, topic_ms_start_pages, ms_divider_page)."""
-    # page 1 front, page 2 TOC
-    p = 2
-    topic_divider_pages = {}
-    topic_ms_start_pages = {}
-
-    def sim_question(q, y, page):
-        # simulate layout for a single question, returning (y, page)
-        y -= 36
-        if y < bottom_margin + 40:
-            page += 1
-            y = height - top_margin - 36
-            y -= 36
-        qtext = tidy_text_for_math(q.get("question_text", ""))
-        parts = re.split(r'(?=\([a-z]\))', qtext, flags=re.IGNORECASE)
-        if len(parts) == 1:
-            for _ in wrapped_lines(parts[0], 95):
+        if parsed.has_parts:
+            for line in parsed.intro_lines:
+                if not line.strip():
+                    y -= line_height; continue
+                y = self.ensure_space(y, line_height)
+                if not printed_number:
+                    self._question_number(q, y)
+                    printed_number = True
+                self._text(text_x, y, line, FONT_SANS, 10.5)
+                last_text_line_y = y
                 y -= line_height
-                if y < bottom_margin + 40:
-                    page += 1
-                    y = height - top_margin - 36
-            lp = lines_per_marks(q.get("marks", 0))
-            for _ in range(lp):
-                y -= (line_height + 2)
-                if y < bottom_margin + 40:
-                    page += 1
-                    y = height - top_margin - 36
-        else:
-            intro = parts[0].strip()
-            if intro:
-                for _ in wrapped_lines(intro, 95):
-                    y -= line_height
-                    if y < bottom_margin + 40:
-                        page += 1
-                        y = height - top_margin - 36
-            for part_block in parts[1:]:
-                if not part_block.strip():
-                    continue
-                m = re.match(r'\(([a-z])\)\s*(.*)', part_block.strip(), re.S | re.I)
-                if not m:
-                    for _ in wrapped_lines(part_block, 95):
+            if last_text_line_y:
+                self._text(width - right_margin, last_text_line_y, f"[{q.marks}]", FONT_BOLD, 9, align="right")
+            y -= 6
+
+            for part in q.parts:
+                if part.label is None:
+                    for line in part.lines:
+                        if not line.strip():
+                            y -= line_height; continue
+                        y = self.ensure_space(y, line_height)
+                        if not printed_number:
+                            self._question_number(q, y)
+                            printed_number = True
+                        self._text(text_x, y, line, FONT_SANS, 10.5)
+                        last_text_line_y = y
                         y -= line_height
-                        if y < bottom_margin + 40:
-                            page += 1
-                            y = height - top_margin - 36
                     continue
-                body = m.group(2).strip()
-                for _ in wrapped_lines(body, 80):
+
+                label = part.label
+                body_lines = part.lines
+
+                # images were prefetched; only draw figures that resolved to a usable file
+                local_name = self.images.get(part.image) if part.image else None
+                if local_name and not _image_is_drawable(local_name):
+                    local_name = None
+                image_est_h = IMAGE_BOX_H if part.image else 0
+
+                needed = (part.body_count * line_height + image_est_h + part.sketch_h
+                          + part.answer_lines * (line_height + 2) + 60)
+                y = self.ensure_space(y, needed)
+
+                self._text(text_x - 20, y, f"({label})", FONT_BOLD, 10.5)
+                for bl in body_lines:
+                    if not bl.strip():
+                        y -= line_height
+                        continue
+                    if not printed_number:
+                        self._question_number(q, y)
+                        printed_number = True
+                    # shift part text rightwards so it doesn’t clash with number
+                    self._text(text_x + 12, y, bl, FONT_SANS, 10.5)   # +12 offset
+                    y -= line_height
+                    last_text_line_y = y
                     y -= line_height
-                    if y < bottom_margin + 40:
-                        page += 1
-                        y = height - top_margin - 36
-                if q.get("image") or any(q.get("_images_for_parts", {}).values()):
-                    y -= 4.0 * cm
-                    if y < bottom_margin + 40:
-                        page += 1
-                        y = height - top_margin - 36
-                mmarks = re.search(r'\[(\d+)\]', body)
-                marks_for_part = int(mmarks.group(1)) if mmarks else 0
-                lp = lines_per_marks(marks_for_part)
-                for _ in range(lp):
-                    y -= (line_height + 2)
-                    if y < bottom_margin + 40:
-                        page += 1
-                        y = height - top_margin - 36
-        y -= 12
-        if y < bottom_margin + 40:
-            page += 1
-            y = height - top_margin - 36
-        return y, page
-
-    # --- simulate topical content ---
-    page = p
-    for t in topics:
-        # divider consumes a page -> that is the divider page for this topic
-        page += 1
-        topic_divider_pages[t] = page
-
-        # questions start on the next page
-        page += 1
-        y = height - top_margin - 36
-
-        for q in [qq for qq in questions if qq["chapter_title"] == t]:
-            y, page = sim_question(q, y, page)
-            # if the question explicitly ends the topic, simulate the forced page break
-            if q.get("end_of_topic"):
-                page += 1
-                y = height - top_margin - 36
 
-    # --- simulate marking scheme pages ---
-    # place the MS divider on the page after the last topical page
-    ms_divider = max(page - 1, p + 1)
+                if local_name:
+                    max_w, max_h = IMAGE_BOX_W, IMAGE_BOX_H
+                    if y - max_h < bottom_margin + 20:
+                        y = self.start_new_page(None)
+                    self._block(("image", local_name, text_x, y - max_h, max_w, max_h))
+                    y -= (max_h + 12)
 
-    # start simulation from the divider page; MS content begins on the page after the divider
-    page = ms_divider
+                if part.sketch_h:
+                    y = self._sketch_box(y, part.sketch_h)
 
-    for t in topics:
-        # MS topic will start on the next page
-        page += 1
-        topic_ms_start_pages[t] = page
+                # answer lines only if the part isn't sketch-only
+                y = self._answer_lines(y, part.answer_lines)
 
-        # start at top of that page
-        y = height - top_margin - 36
-        y -= 20  # header area for MS topic
+        else:
+            body_lines = parsed.intro_lines
+            body_count = sum(1 for L in body_lines if L.strip())
+            sketch_h = q.whole_sketch_h
 
-        for q in [qq for qq in questions if qq["chapter_title"] == t]:
-            y -= 18  # small gap per question/block
-            if y < bottom_margin + 60:
-                page += 1
+            needed = body_count * line_height + sketch_h + q.answer_lines * (line_height + 2) + 60
+            y = self.ensure_space(y, needed)
+            for bl in body_lines:
+                if not bl.strip():
+                    y -= line_height; continue
+                if not printed_number:
+                    self._question_number(q, y)
+                    printed_number = True
+                self._text(text_x, y, bl, FONT_SANS, 10.5)
+                last_text_line_y = y
+                y -= line_height
+            if last_text_line_y:
+                self._text(width - right_margin, last_text_line_y, f"[{q.marks}]", FONT_BOLD, 9, align="right")
+
+            # single-block sketch area (if any)
+            if sketch_h:
+                y = self._sketch_box(y, sketch_h)
+                # breathing space before answer lines (or after a sketch-only box)
+                y -= line_height * 2
+
+            # answer lines (unless whole sketch_only)
+            y = self._answer_lines(y, q.answer_lines)
+
+        if instr.debug_on:
+            instr.debug(f"End question {q.question_number} at y={y}", self.layout.page.number)
+        return y
+
+    def place_topic(self, topic, topic_questions):
+        # the divider gets a page of its own even when the previous topic's last
+        # question isn't marked end_of_topic (e.g. it was filtered out or sorted away)
+        self.finish_page(start_new=True)
+        y = self.place_topic_divider(topic)
+        # iterate over questions in topic preserving input order
+        for q in topic_questions:
+            y = self.place_question(q, y)
+            y -= 12
+            # If the question explicitly ends the topic, force a clean page break so next divider starts on a fresh page
+            if q.end_of_topic:
+                if instr.debug_on:
+                    instr.debug("Question marked end_of_topic -> forcing page break", self.layout.page.number)
+                y = self.start_new_page(None)
+
+    # ---------- marking scheme ----------
+    def place_marking_scheme(self, questions_by_topic, topics, on_section=None):
+        lay = self.layout
+        # 1) Ensure a clean page and place MS divider (force the page break so divider is alone)
+        self.finish_page(start_new=True, force=True)
+        self._text(width/2, height/2 + 20, "Marking Scheme", FONT_SERIF_BOLD, 20, align="centre")
+        self._text(width/2, height/2 - 6, "Answers grouped by topic", FONT_SANS, 13, align="centre")
+        lay.ms_divider_page = lay.page.number
+        if instr.debug_on:
+            instr.debug("At MS divider", lay.page.number)
+        self.finish_page(start_new=True, force=True)
+
+        # 2) For each topic: MS starts on its own page, record its start page, place table
+        for topic in topics:
+            self.finish_page(start_new=False, force=False)  # no-op if page empty, safe otherwise
+            lay.topic_ms_start_pages[topic] = lay.page.number
+            if instr.debug_on:
+                instr.debug(f"MS for topic '{topic}' starts", lay.page.number)
+
+            with instr.span("ms_table", topic=topic):
+                pieces = split_ms_table(build_ms_table(questions_by_topic[topic]))
+            key = ms_table_key(questions_by_topic[topic])
+            for i, (piece, h_piece) in enumerate(pieces):
+                if i:
+                    # the rest of the table continues on a fresh page under the repeated header row
+                    self.finish_page(start_new=True, force=True)
                 y = height - top_margin - 36
-                y -= 18
+                self._text(left_margin, y, topic + " — Marking Scheme" + (" (cont.)" if i else ""), FONT_BOLD, 14)
+                y -= 20
+                self._block(("flowable", piece, left_margin, y - h_piece, f"{key}:{i}"))
 
-            qtext = tidy_text_for_math(q.get("question_text", ""))
-            has_parts = bool(re.search(r'\([a-z]\)', qtext, flags=re.IGNORECASE))
+            # After finishing a topic MS, force a page break so the next topic's MS starts on its own page.
+            self.finish_page(start_new=True, force=True)
+            if on_section:
+                on_section(lay)
 
-            if not has_parts:
-                para_lines = wrapped_lines(next(iter(q.get("answer_text", {}).values()), ""), 95)
-                for _ in para_lines:
-                    y -= line_height
-                    if y < bottom_margin + 60:
-                        page += 1
-                        y = height - top_margin - 36
-            else:
-                for part in sorted(q.get("answer_text", {}).keys()):
-                    para_lines = wrapped_lines(q["answer_text"][part], 95)
-                    for _ in para_lines:
-                        y -= line_height
-                        if y < bottom_margin + 60:
-                            page += 1
-                            y = height - top_margin - 36
-                            y -= line_height
-            y -= 12
+        # Final footer on last page (do not add spurious pages)
+        self.finish_page(start_new=False)
 
-        # we do NOT force an extra page increment here because rendering forces a clean page after each topic;
-        # the page variable already reflects how many pages the MS topic consumed.
 
-    return topic_divider_pages, topic_ms_start_pages, ms_divider
+def collect_image_refs(questions):
+    """Every image reference used by the (normalized) questions, in first-use order."""
+    return list(dict.fromkeys(ref for q in questions for ref in q.images_for_parts.values() if ref))
 
-topic_divider_pages, topic_ms_start_pages, ms_divider_page = simulate_layout(questions, topics_in_order)
+def layout_booklet(questions, topics, title=DEFAULT_TITLE, images=None, on_section=None):
+    """Lay the whole booklet out once and return its BookletLayout.
 
-print("SIMULATION: topic divider pages:", topic_divider_pages)
-print("SIMULATION: topic MS start pages:", topic_ms_start_pages)
-print("SIMULATION: MS divider page:", ms_divider_page)
+    images maps image references to local, box-sized paths (see prefetch_images
+    and prepare_images); when omitted the references are resolved here.
+    on_section(layout), if given, is called after each topic and each MS topic;
+    every page but the last in layout.pages is finished at that point.
+    """
+    if images is None:
+        images = prepare_images(prefetch_images(collect_image_refs(questions)), IMAGE_BOX_W, IMAGE_BOX_H)
+    questions_by_topic = {t: [] for t in topics}
+    for q in questions:
+        if q.chapter_title in questions_by_topic:
+            questions_by_topic[q.chapter_title].append(q)
+
+    engine = LayoutEngine(images)
+    with instr.span("layout.front_matter"):
+        engine.place_front_page(title)
+        engine.place_toc(topics)
+    for topic in topics:
+        with instr.span("layout.topic", topic=topic, questions=len(questions_by_topic[topic])):
+            engine.place_topic(topic, questions_by_topic[topic])
+        if on_section:
+            on_section(engine.layout)
+    with instr.span("layout.marking_scheme"):
+        engine.place_marking_scheme(questions_by_topic, topics, on_section)
+    engine.finalize_toc(topics)
+    instr.count("questions", len(questions))
+    return engine.layout
 
 # -------------------------
-# FRONT PAGE
+# Fast page map (prefix sums instead of placing blocks)
 # -------------------------
-c.setFont("Times-Bold", 22)
-c.drawCentredString(width/2, height/2 + 40, "Physics — Topical Past Papers")
-c.setFont("Helvetica", 12)
-c.drawCentredString(width/2, height/2 + 15, "Compiled booklet")
-page_has_content = True
-finish_page(start_new=True)
+# Every vertical step the LayoutEngine takes has the form "break to a fresh page
+# if y - need < bottom_margin + 20, then y -= advance".  A question therefore
+# compiles, independently of where it lands, to a QuestionSteps: the prefix sums
+# of its advances and, per step, key = prefix sum + need.  Starting at height y
+# the question breaks at the first step whose key exceeds y - bottom_margin - 20,
+# so a running maximum of the keys answers "does it fit?" in O(1) and "where
+# does it break?" with one bisect per page, instead of one Python step per line.
+# Steps taken without a space check (blank lines, gaps) are folded into the
+# advance of the step before them.  Tables are measured from their row heights
+# (the same paddings and leadings as the real Table) without building flowables.
+QuestionSteps = namedtuple("QuestionSteps", "sums keys run_max total")
+
+_FORCE = float("inf")       # unconditional page break (end_of_topic)
+_page_top = height - top_margin - 36
+_break_limit = bottom_margin + 20
+_TABLE_PAD = 12
+
+def question_steps(q, drawable, parsed=None):
+    """QuestionSteps for the y steps LayoutEngine.place_question takes for q.
+
+    drawable is the set of image references that will be drawn (drawable_figures).
+    """
+    needs, advs = [36], [16]
+    answer_step = line_height + 2
+
+    def text_lines(lines):
+        for line in lines:
+            if line:
+                needs.append(line_height)
+                advs.append(line_height)
+            else:
+                advs[-1] += line_height
+
+    parsed = parsed or parse_question(q)
+    if parsed.has_parts:
+        text_lines(parsed.intro_lines)
+        advs[-1] += 6
+        for part in q.parts:
+            if part.label is None:
+                text_lines(part.lines)
+                continue
+            needs.append(part.body_count * line_height + (IMAGE_BOX_H if part.image else 0) + part.sketch_h
+                         + part.answer_lines * answer_step + 60)
+            advs.append(line_height * (len(part.lines) + part.body_count))
+            if part.image in drawable:
+                needs.append(IMAGE_BOX_H)
+                advs.append(IMAGE_BOX_H + 12)
+            if part.sketch_h:
+                needs.append(part.sketch_h)
+                advs.append(part.sketch_h + 24)
+            needs.extend([0] * part.answer_lines)
+            advs.extend([answer_step] * part.answer_lines)
+            advs[-1] += 8
+    else:
+        lines = parsed.intro_lines
+        sketch_h = q.whole_sketch_h
+        body_count = len(lines) - lines.count("")
+        needs.append(body_count * line_height + sketch_h + q.answer_lines * answer_step + 60)
+        advs.append(line_height * len(lines))
+        if sketch_h:
+            needs.append(sketch_h)
+            advs.append(sketch_h + 24 + 2 * line_height)
+        needs.extend([0] * q.answer_lines)
+        advs.extend([answer_step] * q.answer_lines)
+        advs[-1] += 8
+
+    advs[-1] += 12   # gap after every question
+    if q.end_of_topic:
+        needs.append(_FORCE)
+        advs.append(0)
+    sums = list(accumulate(advs, initial=0))
+    keys = list(map(add, sums, needs))
+    return QuestionSteps(sums, keys, list(accumulate(keys, max)), sums.pop())
+
+def drawable_figures(questions, images=None):
+    """Image references the layout will draw, given the prefetch/prepare output in images.
+
+    Without images nothing has been fetched yet: local files are checked and
+    URLs are assumed to download.
+    """
+    if images is not None:
+        return {ref for ref, path in images.items() if path and _image_is_drawable(path)}
+    return {ref for ref in collect_image_refs(questions)
+            if (_image_is_drawable(ref) if os.path.exists(ref) else is_url(ref))}
+
+def fit_questions(steps, y=_page_top):
+    """Place QuestionSteps one after another from height y; returns (page breaks, final y)."""
+    breaks = 0
+    fresh_limit = _page_top - _break_limit
+    for st in steps:
+        limit = y - _break_limit
+        if st.run_max[-1] <= limit:
+            y -= st.total   # fits without a break: the common case
+            continue
+        run_max, lo, last = st.run_max, 0, None
+        while True:
+            i = bisect_right(run_max, limit, lo)
+            if i >= len(run_max):
+                break
+            breaks += 1
+            last = i
+            limit = fresh_limit + st.sums[i]
+            lo = i + 1
+            if st.keys[i] > limit and lo < len(run_max):
+                # the step that broke doesn't fit a fresh page either (or was a forced
+                # break): restart the running maximum after it
+                run_max = run_max[:lo] + list(accumulate(st.keys[lo:], max))
+        y = y - st.total if last is None else _page_top - (st.total - st.sums[last])
+    return breaks, y
+
+def _toc_table_height(topics):
+    topic_w = content_width - 3.0*cm - 8 - 6
+    rows = (max(14, 14 * paragraph_line_count(t, FONT_SANS, 12, topic_w)) for t in topics)
+    return 16 + _TABLE_PAD + sum(r + _TABLE_PAD for r in rows)
+
+def _ms_row_heights(topic_questions, parsed):
+    """Row heights of build_ms_table's rows (header excluded)."""
+    answer_w = content_width - 6.0*cm - _TABLE_PAD
+    rows = []
+    for q, p in zip(topic_questions, parsed):
+        answers = q.answer_text
+        if p.has_parts:
+            texts = [answers[k] for k in sorted(answers)]
+        else:
+            texts = [next(iter(answers.values()), "")]
+        for text in texts:
+            lines = paragraph_line_count(tidy_text_for_math(text), FONT_SANS, 10, answer_w)
+            rows.append(max(12, 12 * lines) + _TABLE_PAD)
+    return rows
+
+def _ms_table_pages(rows, avail=ms_avail_height):
+    """Pages split_ms_table cuts a table with these row heights into."""
+    header = 12 + _TABLE_PAD
+    if header + sum(rows) <= avail:
+        return 1
+    pages, i = 0, 0
+    while i < len(rows):
+        h, start = header, i
+        while i < len(rows) and h + rows[i] <= avail:
+            h += rows[i]
+            i += 1
+        pages += 1
+        if i == start:
+            # a row taller than the page: the rest overflows on this page, as in split_ms_table
+            break
+    return pages
+
+def page_map(questions, topics=None, images=None):
+    """Page map of the booklet (see BookletLayout.page_map) without laying it out.
+
+    questions must be normalized.  images, when given, is the prefetch/prepare
+    output; otherwise only local figure files are checked.  Table rows are
+    measured with paragraph_line_count, which follows reportlab's line breaking
+    for plain text but not inline markup.
+    """
+    if topics is None:
+        topics = list(dict.fromkeys(q.chapter_title for q in questions))
+    by_topic = {t: [] for t in topics}
+    for q in questions:
+        if q.chapter_title in by_topic:
+            by_topic[q.chapter_title].append(q)
+
+    # cover, then both TOC tables on page 2 unless the second one doesn't fit
+    toc_h = _toc_table_height(topics)
+    toc_y = height - top_margin - 40 - toc_h
+    page = 3 if toc_y - 18 - toc_h >= bottom_margin else 4
+
+    drawable = drawable_figures(questions, images)
+    divider_pages = {}
+    parsed = {}
+    open_page = False   # the previous topic's last page holds questions (no end_of_topic break)
+    for topic in topics:
+        page += open_page
+        divider_pages[topic] = page
+        qs = by_topic[topic]
+        parsed[topic] = [parse_question(q) for q in qs]
+        breaks, _ = fit_questions(question_steps(q, drawable, p) for q, p in zip(qs, parsed[topic]))
+        page += 1 + breaks
+        open_page = bool(qs) and not qs[-1].end_of_topic
+
+    ms_divider = page + 1
+    page = ms_divider + 1
+    ms_pages = {}
+    for topic in topics:
+        ms_pages[topic] = page
+        page += _ms_table_pages(_ms_row_heights(by_topic[topic], parsed[topic]))
+    return {
+        "topic_divider_pages": divider_pages,
+        "topic_ms_start_pages": ms_pages,
+        "ms_divider_page": ms_divider,
+        "page_count": page - 1,
+    }
 
 # -------------------------
-# TABLE OF CONTENTS
+# Page packing (optional reordering within topics)
 # -------------------------
-tp_rows = []
-tp_rows.append([Paragraph('<b>Topical Past Papers</b>', toc_header_style), Paragraph('<b>Page</b>', toc_header_style)])
-for topic in topics_in_order:
-    tp_rows.append([Paragraph(topic, toc_entry_style), Paragraph(str(topic_divider_pages.get(topic, '')), toc_entry_style)])
+# Questions normally keep their bank order, and one that doesn't fit the rest of
+# a page pushes itself (or its later parts) onto the next, which can leave a
+# large blank tail, e.g. under a sketch box.  pack_questions reorders each
+# topic's questions to fill pages instead: it places the largest question that
+# still fits whole on the current page (first-fit decreasing), and only when
+# none fits does it start the largest remaining one and let it break.  No
+# question moves across an end_of_topic question, which stays last in its run,
+# and a run keeps its bank order unless packing needs fewer page breaks.  The
+# QuestionSteps of the fast page map make every "does it fit?" a bisect.
+
+def _pack_run(steps):
+    """Packed order (indices into steps) of a run of questions starting on a fresh page."""
+    # by the height each question needs to fit whole; equal heights keep bank order
+    pending = sorted(range(len(steps)), key=lambda i: (steps[i].run_max[-1], -i))
+    extents = [steps[i].run_max[-1] for i in pending]
+    order = []
+    y = _page_top
+    while pending:
+        j = bisect_right(extents, y - _break_limit)
+        if j:
+            i = pending.pop(j - 1)
+            extents.pop(j - 1)
+            y -= steps[i].total
+        else:
+            i = pending.pop()
+            extents.pop()
+            _, y = fit_questions([steps[i]], y)
+        order.append(i)
+    return order
 
-tp_col_widths = [content_width - 3.0*cm, 3.0*cm]
-tp_tbl = Table(tp_rows, colWidths=tp_col_widths)
-tp_tbl.setStyle(TableStyle([
-    ("FONT", (0,0), (-1,0), "Helvetica-Bold", 14),
-    ("BACKGROUND", (0,0), (-1,0), colors.lightgrey),
-    ("ALIGN", (0,0), (-1,-1), "LEFT"),
-    ("VALIGN", (0,0), (-1,-1), "TOP"),
-    ("GRID", (0,0), (-1,-1), 0.5, colors.black),
-    ("LEFTPADDING", (0,0), (-1,-1), 8),
-    ("RIGHTPADDING", (0,0), (-1,-1), 6),
-    ("TOPPADDING", (0,0), (-1,-1), 6),
-    ("BOTTOMPADDING", (0,0), (-1,-1), 6),
-]))
-
-t_w, t_h = tp_tbl.wrap(content_width, height)
-tbl_x = left_margin
-tbl_y = height - top_margin - 40 - t_h
-if tbl_y < bottom_margin:
-    finish_page(start_new=True)
-    tbl_y = height - top_margin - 40 - t_h
-tp_tbl.drawOn(c, tbl_x, tbl_y)
-page_has_content = True
-
-# === CHANGE ===
-# Keep the topical TOC table and the MS TOC table on the same page.
-# Do NOT force a page break here. Instead draw the MS TOC below if it fits.
-gap_after = 18
-y_after = tbl_y - gap_after
-# === END CHANGE ===
-
-ms_rows = []
-ms_rows.append([Paragraph('<b>Marking Scheme</b>', toc_header_style), Paragraph('<b>Page</b>', toc_header_style)])
-for topic in topics_in_order:
-    ms_rows.append([Paragraph(topic, toc_entry_style), Paragraph(str(topic_ms_start_pages.get(topic, '')), toc_entry_style)])
-
-ms_tbl = Table(ms_rows, colWidths=tp_col_widths)
-ms_tbl.setStyle(TableStyle([
-    ("FONT", (0,0), (-1,0), "Helvetica-Bold", 14),
-    ("BACKGROUND", (0,0), (-1,0), colors.lightgrey),
-    ("ALIGN", (0,0), (-1,-1), "LEFT"),
-    ("VALIGN", (0,0), (-1,-1), "TOP"),
-    ("GRID", (0,0), (-1,-1), 0.5, colors.black),
-    ("LEFTPADDING", (0,0), (-1,-1), 8),
-    ("RIGHTPADDING", (0,0), (-1,-1), 6),
-    ("TOPPADDING", (0,0), (-1,-1), 6),
-    ("BOTTOMPADDING", (0,0), (-1,-1), 6),
-]))
-m_w, m_h = ms_tbl.wrap(content_width, height)
-tbl2_y = y_after - m_h
-if tbl2_y < bottom_margin:
-    # if it doesn't fit, then force a new page and draw the MS TOC there
-    finish_page(start_new=True)
-    tbl2_y = height - top_margin - 40 - m_h
-ms_tbl.drawOn(c, tbl_x, tbl2_y)
-page_has_content = True
-
-# === CHANGE ===
-# Only force a fresh page after both TOC tables are drawn, so the first topic divider starts on a clean page.
-finish_page(start_new=True, force=True)
-# === END CHANGE ===
-
-# -------------------------
-# Render topical content grouped by topic
-# -------------------------
-# We'll capture the actual divider & MS start pages during rendering to compare with simulation.
-actual_topic_divider_pages = {}       # === CHANGE: ensure this dict exists before draw_topic_divider uses it
-actual_topic_ms_start_pages = {}
-
-def draw_topic_divider(title):
-    global page_has_content
-    # draw divider on current page
-    c.setFont("Times-Bold", 20)
-    c.drawCentredString(width/2, height/2 + 20, title)
-    c.setFont("Helvetica", 13)
-    c.drawCentredString(width/2, height/2 - 6, "Topical Past Papers")
-    page_has_content = True      # mark that this page has content
-
-    # === CHANGE ===
-    # record the actual divider page number at render time
-    actual_topic_divider_pages[title] = c.getPageNumber()
-    # === END CHANGE ===
-
-    # finish the divider page and force a new page for the questions (divider must be alone)
-    finish_page(start_new=True, force=True)
-
-    # Now draw the subtle header on the fresh page, but DO NOT mark page_has_content = True for this header
-    c.setFont("Helvetica-Bold", 9)
-    c.drawCentredString(width/2.0, height - top_margin + 6, "")
-    c.setLineWidth(0.4)
-    c.setStrokeColor(colors.grey)
-    c.line(left_margin, height - top_margin - 2, width - right_margin, height - top_margin - 2)
-    c.setStrokeColor(colors.black)
-
-    return height - top_margin - 36
-
-
-def draw_question(q, y):
-    global page_has_content
-    dbg(f"Start question {q.get('question_number')} ({q.get('chapter_title')}) at y={y}")
-    page_has_content = True
-    ident = f"{q.get('exam_series','')} | {q.get('subject','')} | {q.get('original_ref','')}"
-    y = ensure_space_for_render(y, 36)
-    c.setFont("Helvetica-Oblique", 8.5)
-    c.drawString(left_margin, y, ident)
-    y -= 16
-
-    qtext = tidy_text_for_math(q.get("question_text",""))
-    parts = re.split(r'(?=\([a-z]\))', qtext, flags=re.IGNORECASE)
-    has_parts = len(parts) > 1
-    printed_number = False
-    last_text_line_y = None
-
-    if has_parts:
-        intro = parts[0].strip()
-        intro_lines = wrapped_lines(intro, max_chars=95) if intro else []
-        for line in intro_lines:
-            if not line.strip():
-                y -= line_height; continue
-            y = ensure_space_for_render(y, line_height)
-            if not printed_number:
-                c.setFont("Helvetica-Bold", 11)
-                c.drawString(gutter_x - 12, y, str(q.get("question_number","")))  # shift left by 12 pts
-                printed_number = True
-            c.setFont("Helvetica", 10.5)
-            c.drawString(text_x, y, line)
-            last_text_line_y = y
-            y -= line_height
-        if last_text_line_y:
-            total_marks_label = f"[{q.get('marks',0)}]"
-            c.setFont("Helvetica-Bold", 9)
-            c.drawRightString(width - right_margin, last_text_line_y, total_marks_label)
-        y -= 6
-
-        for part_block in parts[1:]:
-            if not part_block.strip():
-                continue
-            m = re.match(r'\(([a-z])\)\s*(.*)', part_block.strip(), re.S | re.IGNORECASE)
-            if not m:
-                for line in wrapped_lines(part_block, max_chars=95):
-                    if not line.strip():
-                        y -= line_height; continue
-                    y = ensure_space_for_render(y, line_height)
-                    if not printed_number:
-                        c.setFont("Helvetica-Bold", 11)
-                        c.drawString(gutter_x - 12, y, str(q.get("question_number","")))  # shift left by 12 pts
-                        printed_number = True
-                    c.setFont("Helvetica", 10.5)
-                    c.drawString(text_x, y, line)
-                    last_text_line_y = y
-                    y -= line_height
-                continue
+def pack_questions(questions, topics=None, images=None):
+    """Reorder normalized questions within their topics to use fewer pages.
 
-            label = m.group(1).lower()
-            body = m.group(2).strip()
-            body_lines = wrapped_lines(body, max_chars=80)
-            body_lines_count = sum(1 for L in body_lines if L.strip())
+    Returns (questions, pages saved).  Topics keep their order; images is as
+    for page_map.
+    """
+    if topics is None:
+        topics = list(dict.fromkeys(q.chapter_title for q in questions))
+    by_topic = {t: [] for t in topics}
+    for q in questions:
+        if q.chapter_title in by_topic:
+            by_topic[q.chapter_title].append(q)
+
+    drawable = drawable_figures(questions, images)
+    packed = []
+    for topic in topics:
+        qs = by_topic[topic]
+        steps = [question_steps(q, drawable) for q in qs]
+        # runs end after each end_of_topic question (which keeps its place) and at the topic end
+        ends = sorted({i + 1 for i, q in enumerate(qs) if q.end_of_topic} | {len(qs)})
+        start = 0
+        for end in ends:
+            run = list(range(start, end))
+            fixed = [run.pop()] if qs[end - 1].end_of_topic else []
+            order = [run[k] for k in _pack_run([steps[i] for i in run])] + fixed
+            before = fit_questions(steps[i] for i in range(start, end))
+            after = fit_questions(steps[i] for i in order)
+            if (after[0], -after[1]) >= (before[0], -before[1]):
+                order = range(start, end)
+            packed.extend(qs[i] for i in order)
+            start = end
+    saved = page_map(questions, topics, images)["page_count"] - page_map(packed, topics, images)["page_count"]
+    instr.count("pages_saved_by_packing", saved)
+    return packed, saved
 
-            image_present = bool(q["_images_for_parts"].get(label))
-            image_est_h = 4.0 * cm if image_present else 0
+# -------------------------
+# Page templates (form XObjects)
+# -------------------------
+# Rules that repeat on page after page (the header rule, the two rules of a
+# sketch box and runs of dashed answer lines) are drawn once per PDF as a
+# form XObject; every further use is a single Do in the page's content stream.
+# A template is named by (template, arg), e.g. ("answer_lines", 6) is a grid of
+# six lines.  Page numbers and headings differ per page and stay plain text.
+rule_width = width - right_margin - text_x
+
+def _header_rule_lines(_):
+    return [(0, 0, content_width, 0, colors.grey, 0.4, ())]
+
+def _sketch_box_lines(sketch_h):
+    return [(0, 0, rule_width, 0, colors.lightgrey, 0.8, ()),
+            (0, -sketch_h, rule_width, -sketch_h, colors.lightgrey, 0.8, ())]
+
+def _answer_grid_lines(count):
+    step = line_height + 2
+    return [(0, -i * step, rule_width, -i * step, colors.grey, 0.6, (1, 3)) for i in range(count)]
+
+# template -> arg -> line segments (x1, y1, x2, y2, color, line_width, dash) relative to the origin
+PAGE_TEMPLATES = {
+    "header_rule": _header_rule_lines,
+    "sketch_box": _sketch_box_lines,
+    "answer_lines": _answer_grid_lines,
+}
+
+def _define_form(c, name, lines):
+    """Draw lines into the form XObject name on canvas c."""
+    pad = max(lw for *_, lw, _ in lines)
+    xs = [v for ln in lines for v in (ln[0], ln[2])]
+    ys = [v for ln in lines for v in (ln[1], ln[3])]
+    c.beginForm(name, min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad)
+    for x1, y1, x2, y2, color, line_width, dash in lines:
+        c.setStrokeColor(color)
+        c.setLineWidth(line_width)
+        c.setDash(*dash)
+        c.line(x1, y1, x2, y2)
+    c.endForm()
 
-            # per-part sketch height and sketch_only flag (NEW logic)
-            sketch_h_cm = _get_part_sketch_height(q, label)
-            sketch_only_for_part = _is_part_sketch_only(q, label)
+# -------------------------
+# Renderer (replays the layout)
+# -------------------------
+def render_pages(c, pages, kinds=None):
+    """Draw the placed blocks of pages onto canvas c, one showPage() per page.
 
-            mmarks = re.search(r'\[(\d+)\]', body)
-            marks_for_part = int(mmarks.group(1)) if mmarks else 0
-            lp = lines_per_marks(marks_for_part)
+    kinds optionally restricts which block kinds are drawn (e.g. only the page
+    numbers, or everything but them).
+    """
+    load_all_fonts()
+    state = {}
+    forms = {}   # (template, arg) -> name of its form on this canvas
+
+    def set_state(key, value, setter):
+        if state.get(key) != value:
+            setter(*value)
+            state[key] = value
+
+    drawn = dict.fromkeys(("text", "page_number", "line", "image", "flowable", "form"), 0)
+    for page in pages:
+        for block in page.blocks:
+            kind = block[0]
+            if kinds is not None and kind not in kinds:
+                continue
+            drawn[kind] += 1
+            if kind == "text":
+                _, x, y, s, font, size, align, color = block
+                set_state("font", (font, size), c.setFont)
+                set_state("fill", (color,), c.setFillColor)
+                if align == "right":
+                    c.drawRightString(x, y, s)
+                elif align == "centre":
+                    c.drawCentredString(x, y, s)
+                else:
+                    c.drawString(x, y, s)
+            elif kind == "page_number":
+                _, x, y, s, font, size = block
+                set_state("font", (font, size), c.setFont)
+                set_state("fill", (colors.black,), c.setFillColor)
+                c.drawRightString(x, y, s)
+            elif kind == "line":
+                _, x1, y1, x2, y2, color, line_width, dash = block
+                set_state("stroke", (color,), c.setStrokeColor)
+                set_state("line_width", (line_width,), c.setLineWidth)
+                set_state("dash", dash, c.setDash)
+                c.line(x1, y1, x2, y2)
+            elif kind == "image":
+                _, path, x, y, w, h = block
+                try:
+                    c.drawImage(path, x, y, w, h, preserveAspectRatio=True, mask='auto')
+                except Exception:
+                    pass
+            elif kind == "flowable":
+                flowable, x, y = block[1:4]
+                flowable.drawOn(c, x, y)
+            elif kind == "form":
+                _, template, arg, x, y = block
+                name = forms.get((template, arg))
+                if name is None:
+                    # short names: each use also lists the form in its page's resources
+                    name = forms[template, arg] = f"T{len(forms)}"
+                    _define_form(c, name, PAGE_TEMPLATES[template](arg))
+                c.saveState()
+                c.translate(x, y)
+                c.doForm(name)
+                c.restoreState()
+        c.showPage()
+        # graphics state is reset on every new page
+        state.clear()
+    if instr.enabled:
+        instr.count("pages_rendered", len(pages))
+        instr.count("text_drawn", drawn["text"])
+        instr.count("lines_drawn", drawn["line"])
+        instr.count("images_embedded", drawn["image"])
+        instr.count("tables_drawn", drawn["flowable"])
+        instr.count("templates_drawn", drawn["form"])
+        instr.count("templates_defined", len(forms))
+
+BODY_BLOCK_KINDS = frozenset(("text", "line", "image", "flowable", "form"))
+
+def render_layout(c, layout):
+    """Draw every laid-out page onto canvas c."""
+    render_pages(c, layout.emitted_pages)
 
-            # if sketch_only for this part, we do not reserve answer lines after the sketch
-            lines_to_draw = 0 if sketch_only_for_part else lp
+# -------------------------
+# Incremental rebuild (cached per-topic fragments)
+# -------------------------
+# The layout is always recomputed (it is cheap); what is cached is the rendered
+# PDF of each topic's question pages and of each topic's marking-scheme pages.
+# A fragment is keyed by a fingerprint of the blocks placed on its pages, so it
+# is reused whenever the topic lays out identically, wherever it lands in the
+# booklet.  Fragments are stored without page numbers; the numbers, the cover,
+# the TOC and the MS divider are rendered fresh and the booklet is reassembled
+# with pypdf.  The fragment directory is an OutputCache, so unused fragments age
+# out and the total stays under its size limit.
+DEFAULT_FRAGMENT_DIR = os.path.join(CACHE_ROOT, "fragments")
+
+def _fingerprint_pages(pages):
+    from image_cache import file_digest
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"render:{RENDER_VERSION}".encode("utf-8"))
+    for page in pages:
+        h.update(b"\f")
+        for block in page.blocks:
+            kind = block[0]
+            if kind == "page_number":
+                continue
+            if kind == "flowable":
+                block = ("flowable", block[4], block[2], block[3])
+            elif kind == "image":
+                block = ("image", file_digest(block[1])) + block[2:]
+            h.update(repr(block).encode("utf-8"))
+    return h.hexdigest()
+
+def layout_segments(layout, topics):
+    """Split the emitted pages into [(pages, cacheable)] runs in booklet order.
+
+    Each topic's question pages and each topic's MS pages form a cacheable run;
+    the cover, TOC and MS divider are not cached.
+    """
+    starts = [(1, False)]
+    starts.extend((layout.topic_divider_pages[t], True) for t in topics)
+    starts.append((layout.ms_divider_page, False))
+    starts.extend((layout.topic_ms_start_pages[t], True) for t in topics)
+
+    pages = layout.emitted_pages
+    segments = []
+    for i, (first, cacheable) in enumerate(starts):
+        last = starts[i + 1][0] - 1 if i + 1 < len(starts) else len(pages)
+        if last >= first:
+            segments.append((pages[first - 1:last], cacheable))
+    return segments
+
+def build_incremental(layout, topics, output, fragment_dir=DEFAULT_FRAGMENT_DIR):
+    """Write layout to output, reusing cached topic fragments; returns (reused, rendered)."""
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        raise RuntimeError("incremental builds need pypdf (pip install pypdf)")
+    import io
+    from reportlab.pdfgen import canvas
+    fragments = OutputCache(fragment_dir)
+
+    segments = layout_segments(layout, topics)
+    frame_pages, numbered_pages, fragment_paths = [], [], []
+    reused = rendered = 0
+    for pages, cacheable in segments:
+        if not cacheable:
+            frame_pages.extend(pages)
+            fragment_paths.append(None)
+            continue
+        key = _fingerprint_pages(pages)
+        hit = fragments.get(key)
+        if hit:
+            path = hit[0]
+            reused += 1
+        else:
+            fd, tmp = tempfile.mkstemp(dir=fragment_dir, suffix=".tmp")
+            os.close(fd)
+            try:
+                with instr.span("render_fragment", pages=len(pages)):
+                    c = canvas.Canvas(tmp, pagesize=A4)
+                    render_pages(c, pages, kinds=BODY_BLOCK_KINDS)
+                    c.save()
+                # evicted only after assembly, so this booklet's fragments stay put
+                fragments.put(key, tmp, {"page_count": len(pages)}, evict=False)
+            finally:
+                os.remove(tmp)
+            path = fragments.get(key)[0]
+            rendered += 1
+        numbered_pages.extend(pages)
+        fragment_paths.append(path)
+
+    instr.count("fragments_reused", reused)
+    instr.count("fragments_rendered", rendered)
+    frame_buf, stamp_buf = io.BytesIO(), io.BytesIO()
+    c = canvas.Canvas(frame_buf, pagesize=A4)
+    render_pages(c, frame_pages)
+    c.save()
+    c = canvas.Canvas(stamp_buf, pagesize=A4)
+    render_pages(c, numbered_pages, kinds=("page_number",))
+    c.save()
+
+    with instr.span("assemble", pages=len(numbered_pages)):
+        frame = iter(PdfReader(frame_buf).pages)
+        stamps = iter(zip(numbered_pages, PdfReader(stamp_buf).pages))
+        writer = PdfWriter()
+        for (pages, cacheable), path in zip(segments, fragment_paths):
+            if not cacheable:
+                for _ in pages:
+                    writer.add_page(next(frame))
+                continue
+            for fragment_page in PdfReader(path).pages:
+                page, stamp = next(stamps)
+                out_page = writer.add_page(fragment_page)
+                if any(b[0] == "page_number" for b in page.blocks):
+                    out_page.merge_page(stamp)
+        if hasattr(output, "write"):
+            writer.write(output)
+        else:
+            with open(output, "wb") as f:
+                writer.write(f)
+    fragments.evict()
+    return reused, rendered
 
-            needed = body_lines_count * line_height + image_est_h + sketch_h_cm + lines_to_draw * (line_height + 2) + 60
-            y = ensure_space_for_render(y, needed)
+# -------------------------
+# Parallel render (topic segments in worker processes)
+# -------------------------
+# The pages are split as for the incremental build: each topic's question pages
+# and each topic's MS pages form a segment.  The layout, and with it every page
+# number and TOC entry, is final before anything is drawn, so a worker renders
+# its segment complete with page numbers.  The cover, TOC and MS divider are
+# rendered here meanwhile, and the pieces are concatenated in booklet order.
+# Every piece is seeded with the booklet's characters (fonts.seed_subsets), so
+# the pieces embed identical font subsets and the merged file carries one copy.
+def booklet_chars(questions, title=DEFAULT_TITLE):
+    """Every character the booklet's text can draw: record fields as printed, title, headings."""
+    chars = set(title) | set(" — Marking Scheme (cont.)")
+    def walk(value):
+        if isinstance(value, str):
+            chars.update(value)
+            chars.update(tidy_text_for_math(value))
+        elif isinstance(value, dict):
+            for v in value.values():
+                walk(v)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                walk(v)
+    for q in questions:
+        walk(q.to_dict())
+    return "".join(sorted(chars))
+
+def _render_segment(pages, path, chars=""):
+    """Draw pages into a new PDF at path (runs in a worker process)."""
+    from reportlab.pdfgen import canvas
+    c = canvas.Canvas(path, pagesize=A4)
+    seed_subsets(c, chars)
+    render_pages(c, pages)
+    c.save()
+    return path
+
+def render_parallel(layout, topics, output, workers=None, tmp_dir=None, chars=""):
+    """Render layout to output with its topic segments spread over a process pool.
+
+    chars (see booklet_chars) seeds each segment's font subsets so pdf_concat
+    can merge them.  Returns the number of segments rendered by workers.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from pdf_concat import concat_pdfs
+    import shutil
+    segments = layout_segments(layout, topics)
+    work_dir = tempfile.mkdtemp(prefix="ppp-parallel-", dir=tmp_dir)
+    paths = [os.path.join(work_dir, f"{i:04d}.pdf") for i in range(len(segments))]
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # longest segments first, so a big topic doesn't start last and hold up the merge
+            jobs = sorted((i for i, (_, cacheable) in enumerate(segments) if cacheable),
+                          key=lambda i: -len(segments[i][0]))
+            futures = [pool.submit(_render_segment, segments[i][0], paths[i], chars) for i in jobs]
+            with instr.span("render_front_matter"):
+                for (pages, cacheable), path in zip(segments, paths):
+                    if not cacheable:
+                        _render_segment(pages, path, chars)
+            for fut in futures:
+                fut.result()
+        instr.count("segments_rendered_in_workers", len(jobs))
+        with instr.span("assemble", pages=layout.page_count):
+            concat_pdfs(paths, output)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return len(jobs)
 
-            c.setFont("Helvetica-Bold", 10.5)
-            c.drawString(text_x - 20, y, f"({label})")
-            c.setFont("Helvetica", 10.5)
-            for bl in body_lines:
-                if not bl.strip():
-                    y -= line_height
-                    continue
-                if not printed_number:
-                    c.setFont("Helvetica-Bold", 11)
-                    c.drawString(gutter_x - 12, y, str(q.get("question_number","")))  # shift left by 12 pts
-                    printed_number = True
-                    c.setFont("Helvetica", 10.5)
-                # shift part text rightwards so it doesn’t clash with number
-                c.drawString(text_x + 12, y, bl)   # +12 offset
-                last_text_line_y = y
-                y -= line_height
-                last_text_line_y = y
-                y -= line_height
+# -------------------------
+# Streaming output (bounded memory)
+# -------------------------
+# reportlab keeps every page of a Canvas in memory until save().  In streaming
+# mode finished pages are rendered to temporary chunk PDFs while the layout is
+# still running, and their blocks are dropped; the cover and TOC (whose page
+# numbers are only known at the end) are rendered last, and the chunks are
+# concatenated object by object (pdf_concat), so memory stays flat.
+
+class PageStreamer:
+    """on_section callback for layout_booklet() that flushes finished pages to disk."""
+    def __init__(self, topics, chunk_pages=50, tmp_dir=None, chars=""):
+        self.first_topic = topics[0] if topics else None
+        self.chunk_pages = chunk_pages
+        self.tmp_dir = tmp_dir
+        self.chars = chars       # seeds every chunk's font subsets (see booklet_chars)
+        self.front_end = None    # pages[:front_end] are the cover and TOC
+        self.next_index = None   # first body page (0-based) not yet written
+        self.chunks = []
+
+    def _write(self, pages):
+        from reportlab.pdfgen import canvas
+        fd, path = tempfile.mkstemp(dir=self.tmp_dir, suffix=".pdf")
+        os.close(fd)
+        with instr.span("render_chunk", pages=len(pages)):
+            c = canvas.Canvas(path, pagesize=A4)
+            seed_subsets(c, self.chars)
+            render_pages(c, pages)
+            c.save()
+        for page in pages:
+            page.blocks = []   # release text, tables and image refs
+            page.flushed = True
+        return path
+
+    def __call__(self, layout):
+        if self.next_index is None:
+            # pages before the first divider (cover + TOC) stay in memory until the TOC is final
+            self.front_end = self.next_index = layout.topic_divider_pages[self.first_topic] - 1
+        finished = len(layout.pages) - 1
+        if finished - self.next_index >= self.chunk_pages:
+            self.chunks.append(self._write(layout.pages[self.next_index:finished]))
+            self.next_index = finished
+
+    def finish(self, layout, output):
+        """Write the remaining pages and the front matter, then concatenate everything into output."""
+        from pdf_concat import concat_pdfs
+        count = layout.page_count
+        if self.next_index is None:
+            self.front_end = self.next_index = count
+        del layout.pages[count:]   # drop the never-emitted trailing blank page
+        if count > self.next_index:
+            self.chunks.append(self._write(layout.pages[self.next_index:count]))
+        front = self._write(layout.pages[:self.front_end]) if self.front_end else None
+        try:
+            with instr.span("concat", chunks=len(self.chunks) + bool(front)):
+                concat_pdfs(([front] if front else []) + self.chunks, output)
+        finally:
+            for path in ([front] if front else []) + self.chunks:
+                os.remove(path)
+            self.chunks = []
+
+# -------------------------
+# Output cache key
+# -------------------------
+# bump when the drawing code changes what a page looks like without moving any
+# of the constants below, so cached booklets and fragments are not reused
+RENDER_VERSION = 1
+
+def layout_params():
+    """Every constant that changes where things land on the page."""
+    return {
+        "render_version": RENDER_VERSION,
+        "page": [width, height],
+        "margins": [left_margin, right_margin, top_margin, bottom_margin],
+        "text_x": text_x,
+        "line_height": line_height,
+        "sketch_h": DEFAULT_SKETCH_H,
+        "lines_per_mark": LINES_PER_MARK,
+        "image_box": [IMAGE_BOX_W, IMAGE_BOX_H],
+        "ms_avail_height": ms_avail_height,
+        "fonts": [FONT_SANS, FONT_BOLD, FONT_ITALIC, FONT_SERIF_BOLD],
+        "parse_version": PARSE_VERSION,
+    }
 
-            img_url = q["_images_for_parts"].get(label)
-            if img_url:
-                local_ext = os.path.splitext(img_url)[1] or ".img"
-                local_name = download_image(img_url, f"img_q{q.get('question_number')}_{label}" + local_ext)
-                if local_name and os.path.exists(local_name):
-                    try:
-                        max_w, max_h = 7.0 * cm, 4.0 * cm
-                        if y - max_h < bottom_margin + 20:
-                            y = start_new_page(None)
-                        c.drawImage(local_name, text_x, y - max_h, max_w, max_h, preserveAspectRatio=True, mask='auto')
-                        y -= (max_h + 12)
-                    except Exception:
-                        pass
-
-            # draw sketch area if requested (keeps previous behavior for numeric sizes)
-            if sketch_h_cm:
-                rect_top = y
-                rect_bottom = y - sketch_h_cm
-                if rect_bottom < bottom_margin + 20:
-                    y = start_new_page(None)
-                    rect_top = y
-                    rect_bottom = y - sketch_h_cm
-                # Draw a clean sketch area (no dashed box, just top & bottom lines)
-                c.setStrokeColor(colors.lightgrey)
-                c.setLineWidth(0.8)
-
-                # Top line
-                c.line(text_x, rect_top, width - right_margin, rect_top)
-                # Bottom line
-                c.line(text_x, rect_bottom, width - right_margin, rect_bottom)
-
-                c.setStrokeColor(colors.black)
-
-                y = rect_bottom - 24
-
-            # draw answer lines only if not sketch_only_for_part
-            c.setStrokeColor(colors.grey)
-            c.setLineWidth(0.6)
-            c.setDash(1, 3)
-            for i in range(lines_to_draw):
-                if y < bottom_margin + 20:
-                    y = start_new_page(None)
-                c.line(text_x, y, width - right_margin, y)
-                y -= (line_height + 2)
-            c.setDash()
-            y -= 8
+def booklet_key(questions, title=DEFAULT_TITLE, images=None):
+    """Content hash of a booklet: normalized records, title, layout constants and figures.
 
+    images, when given, is the prefetch_images output, so URL figures are keyed
+    by the bytes they resolved to; otherwise only local figure files are hashed.
+    """
+    from image_cache import file_digest
+    refs = collect_image_refs(questions)
+    if images is None:
+        figures = {ref: file_digest(ref) for ref in refs if os.path.isfile(ref)}
     else:
-        body_lines = wrapped_lines(parts[0], max_chars=95)
-        body_count = sum(1 for L in body_lines if L.strip())
+        figures = {ref: file_digest(images[ref]) if images.get(ref) else None for ref in refs}
+    records = [q.to_dict() for q in questions]
+    data = json.dumps([layout_params(), title, records, figures], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=20).hexdigest()
 
-        # whole-question sketch height and sketch_only
-        sketch_h = _get_whole_sketch_height(q)
-        sketch_only_whole = _is_whole_sketch_only(q)
+# -------------------------
+# Booklet builder (importable API)
+# -------------------------
+_loaded_parse_caches = set()
 
-        lp = lines_per_marks(q.get("marks", 0))
-        lines_to_draw = 0 if sketch_only_whole else lp
+class BookletBuilder:
+    """Build one booklet from a list of question records.
 
-        needed = body_count * line_height + sketch_h + lines_to_draw * (line_height + 2) + 60
-        y = ensure_space_for_render(y, needed)
-        printed_number = False
-        last_text_line_y = None
-        for bl in body_lines:
-            if not bl.strip():
-                y -= line_height; continue
-            if not printed_number:
-                c.setFont("Helvetica-Bold", 11)
-                c.drawString(gutter_x - 12, y, str(q.get('question_number','')))
-                printed_number = True
-            c.setFont("Helvetica", 10.5)
-            c.drawString(text_x, y, bl)
-            last_text_line_y = y
-            y -= line_height
-        if last_text_line_y:
-            total_marks_label = f"[{q.get('marks',0)}]"
-            c.setFont("Helvetica-Bold", 9)
-            c.drawRightString(width - right_margin, last_text_line_y, total_marks_label)
-
-        # draw single-block sketch area (if any)
-        # draw single-block sketch area (if any)
-        if sketch_h:
-            rect_top = y
-            rect_bottom = y - sketch_h
-            if rect_bottom < bottom_margin + 20:
-                y = start_new_page(None)
-                rect_top = y
-                rect_bottom = y - sketch_h
-            # Draw a clean sketch area (no dashed box, just top & bottom lines)
-            c.setStrokeColor(colors.lightgrey)
-            c.setLineWidth(0.8)
-
-            # Top line
-            c.line(text_x, rect_top, width - right_margin, rect_top)
-            # Bottom line
-            c.line(text_x, rect_bottom, width - right_margin, rect_bottom)
-
-            c.setStrokeColor(colors.black)
-
-            y = rect_bottom - 24
-
-            # Add breathing space depending on sketch_only
-            if sketch_only_whole:
-                y -= line_height * 2   # more gap if sketch-only
+    All page state lives on the instance (and on its LayoutEngine), so a
+    long-lived process can build many booklets one after another, or from
+    several threads at once, paying the reportlab import and style setup once.
+    """
+    def __init__(self, questions, output=None, title=DEFAULT_TITLE, image_cache=None, parse_cache=None,
+                 output_cache=None):
+        self.questions = normalize_questions(questions)
+        self.title = title
+        self.image_cache = image_cache
+        # optional OutputCache: unchanged booklets are copied from it instead of rebuilt
+        self.output_cache = output_cache
+        self.from_cache = False
+        # optional path of an on-disk parse cache, loaded once per process and saved after layout
+        self.parse_cache = parse_cache
+        # output may be a path or a binary file-like object (anything reportlab's Canvas accepts)
+        self.output = output if output is not None else os.path.join(os.getcwd(), DEFAULT_OUTPUT_FILENAME)
+        self.topics = list(dict.fromkeys(q.chapter_title for q in self.questions))
+        self.layout = None
+        self._fetched = None
+
+    def lay_out(self):
+        if self.layout is None:
+            self.layout = self._lay_out()
+        return self.layout
+
+    def _lay_out(self, on_section=None):
+        if self.parse_cache and self.parse_cache not in _loaded_parse_caches:
+            load_parse_cache(self.parse_cache)
+            _loaded_parse_caches.add(self.parse_cache)
+        with instr.span("parse", questions=len(self.questions)):
+            for q in self.questions:
+                parse_question(q)
+        with instr.span("prepare_images"):
+            images = prepare_images(self._fetch_images(), IMAGE_BOX_W, IMAGE_BOX_H)
+        with instr.span("layout"):
+            layout = layout_booklet(self.questions, self.topics, self.title, images, on_section)
+        if self.parse_cache:
+            save_parse_cache(self.parse_cache)
+        return layout
+
+    def _fetch_images(self):
+        """prefetch_images output for the booklet's figures (URLs revalidated once per builder)."""
+        if self._fetched is None:
+            refs = collect_image_refs(self.questions)
+            with instr.span("fetch_images", images=len(refs)):
+                self._fetched = prefetch_images(refs, cache=self.image_cache)
+        return self._fetched
+
+    def _copy_from_cache(self):
+        """Serve the booklet from the output cache if it holds this exact booklet."""
+        if self.output_cache is None:
+            return False
+        # figures are resolved first so a changed remote image misses the cache
+        self._key = booklet_key(self.questions, self.title, self._fetch_images())
+        hit = self.output_cache.get(self._key)
+        if hit is None:
+            return False
+        import shutil
+        path, page_map = hit
+        with instr.span("output_cache_copy"):
+            if hasattr(self.output, "write"):
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, self.output)
             else:
-                y -= line_height * 2   # gap before answer lines
+                shutil.copyfile(path, self.output)
+        self.layout = BookletLayout.from_page_map(page_map)
+        self.from_cache = True
+        return True
+
+    def _store_in_cache(self):
+        # file-like outputs can't be read back, so only path outputs are cached
+        if self.output_cache is not None and not hasattr(self.output, "write"):
+            self.output_cache.put(self._key, self.output, self.layout.page_map())
+
+    def build(self):
+        if self._copy_from_cache():
+            return self.output
+        from reportlab.pdfgen import canvas
+        layout = self.lay_out()
+        c = canvas.Canvas(self.output, pagesize=A4)
+        with instr.span("render", pages=layout.page_count):
+            render_layout(c, layout)
+        with instr.span("save"):
+            c.save()
+        self._store_in_cache()
+        return self.output
+
+    def build_streaming(self, chunk_pages=50, tmp_dir=None):
+        """Like build(), but render finished pages to disk in chunks of about
+        chunk_pages as the layout proceeds, so peak memory doesn't grow with
+        the booklet.  The rendered blocks are released: self.layout keeps
+        only the page map afterwards.
+        """
+        if self._copy_from_cache():
+            return self.output
+        streamer = PageStreamer(self.topics, chunk_pages, tmp_dir, booklet_chars(self.questions, self.title))
+        self.layout = self._lay_out(on_section=streamer)
+        streamer.finish(self.layout, self.output)
+        self._store_in_cache()
+        return self.output
+
+    def build_parallel(self, workers=None):
+        """Like build(), but render the topics in worker processes (see render_parallel)."""
+        if self._copy_from_cache():
+            return self.output
+        layout = self.lay_out()
+        with instr.span("render", pages=layout.page_count):
+            render_parallel(layout, self.topics, self.output, workers,
+                            chars=booklet_chars(self.questions, self.title))
+        self._store_in_cache()
+        return self.output
+
+    def build_incremental(self, fragment_dir=DEFAULT_FRAGMENT_DIR):
+        """Like build(), but reuse cached renders of topics that haven't changed.
+
+        Returns (fragments reused, fragments rendered).
+        """
+        return build_incremental(self.lay_out(), self.topics, self.output, fragment_dir)
+
+
+def build_booklet(questions, out=None, **options):
+    """Convenience wrapper: build the booklet and return the finished BookletBuilder."""
+    builder = BookletBuilder(questions, out, **options)
+    builder.build()
+    return builder
 
-        # draw answer lines (unless whole sketch_only)
-        c.setStrokeColor(colors.grey)
-        c.setLineWidth(0.6)
-        c.setDash(1, 3)
-        for i in range(lines_to_draw):
-            if y < bottom_margin + 20:
-                y = start_new_page(None)
-            c.line(text_x, y, width - right_margin, y)
-            y -= (line_height + 2)
-        c.setDash()
-        y -= 8
-
-    dbg(f"End question {q.get('question_number')} on page {c.getPageNumber()} at y={y}")
-    return y
-
-def ensure_space_for_render(y, needed_h):
-    if y - needed_h < bottom_margin + 20:
-        return start_new_page(None)
-    return y
-
-# Keep track: which topic we're in to record actual ms start pages later
-topic_pages_map = {}
-
-# Render topical content grouped by topic
-for topic in topics_in_order:
-    y = draw_topic_divider(topic)
-    # iterate over questions in topic preserving input order
-    topic_questions = [qq for qq in questions if qq["chapter_title"] == topic]
-    for idx, q in enumerate(topic_questions):
-        y = draw_question(q, y)
-        y -= 12
-        # If the question explicitly ends the topic, force a clean page break so next divider starts on a fresh page
-        if q.get("end_of_topic"):
-            dbg("Question marked end_of_topic -> forcing page break")
-            finish_page(start_new=True, force=True)
-            # then set up header for next page if you like (not marking page_has_content)
-            c.setFont("Helvetica-Bold", 9)
-            c.drawCentredString(width/2.0, height - top_margin + 6, "")
-            c.setLineWidth(0.4)
-            c.setStrokeColor(colors.grey)
-            c.line(left_margin, height - top_margin - 2, width - right_margin, height - top_margin - 2)
-            c.setStrokeColor(colors.black)
-            y = height - top_margin - 36
-
-# -------------------------
-# MARKING SCHEME SECTION (REPLACEMENT BLOCK)
-# -------------------------
-# Ensure ms pages dict exists
-# actual_topic_ms_start_pages already declared above
-
-# 1) Ensure a clean page and draw MS divider (force the page break so divider is alone)
-finish_page(start_new=True, force=True)
-c.setFont("Times-Bold", 20)
-c.drawCentredString(width/2, height/2 + 20, "Marking Scheme")
-dbg("Drawing Marking Scheme divider")
-c.setFont("Helvetica", 13)
-c.drawCentredString(width/2, height/2 - 6, "Answers grouped by topic")
-page_has_content = True
-
-# Record MS divider page explicitly
-ms_divider_actual_page = c.getPageNumber()
-dbg(f"At MS divider (actual page {ms_divider_actual_page})")
-
-# Finish divider page and force a fresh page for first MS topic
-finish_page(start_new=True, force=True)
-
-# 2) For each topic: ensure MS starts on its own page, record its start page, draw table
-for topic in topics_in_order:
-    # Start a fresh page for this MS topic (if current page has content, this will advance; force=True ensures a clean start)
-    # However since we just forced a fresh page after the divider, the first topic will start on that page.
-    # To be absolutely robust, force a (possibly empty) page break BEFORE starting each topic except when page is already blank.
-    # Use finish_page with force=True to guarantee page boundaries are consistent.
-    finish_page(start_new=False, force=False)  # no-op if page empty, safe otherwise
-
-    # Record the page number where this MS topic begins
-    actual_ms_start = c.getPageNumber()
-    actual_topic_ms_start_pages[topic] = actual_ms_start
-    dbg(f"MS for topic '{topic}' starts on actual page {actual_ms_start}")
-
-    # Draw MS topic header (this marks the page as having content)
-    c.setFont("Helvetica-Bold", 14)
-    y = height - top_margin - 36
-    c.drawString(left_margin, y, topic + " — Marking Scheme")
-    y -= 20
-    page_has_content = True
 
-    # Build table rows with Marks column. Single-block questions: Part = "-", Marks = total.
-    table_rows = [["Question", "Part", "Marks", "Answer"]]
-    for q in [qq for qq in questions if qq["chapter_title"] == topic]:
-        qtext = tidy_text_for_math(q.get("question_text", ""))
-        has_parts = bool(re.search(r'\([a-z]\)', qtext, flags=re.IGNORECASE))
-        if not has_parts:
-            # single-block question -> single row with Part = "-" and Marks = question marks
-            ans_text = tidy_text_for_math(next(iter(q.get("answer_text", {}).values()), ""))
-            para = Paragraph(ans_text, normal_style)
-            table_rows.append([f"{q.get('question_number')}", "-", f"{q.get('marks', 0)}", para])
+# -------------------------
+# Batch mode (one booklet per manifest entry, spread over processes)
+# -------------------------
+# Manifest (JSON):
+#   {
+#     "questions": "bank.jsonl",         # optional; .jsonl/.db bank or .json list, path relative to manifest
+#     "workers": 4,                      # optional; overridden by --workers
+#     "parse_cache": "parsed.json",      # optional; parse cache shared by every booklet
+#     "booklets": [
+#       {"output": "waves.pdf", "title": "Waves revision",
+#        "filters": {"chapter_title": ["Waves"], "exam_series": "May/Jun 2015"}},
+#       {"output": "recent-long.pdf", "filters": {"year": [2021, 2022, 2023], "paper": "22", "min_marks": 4},
+#        "order_by": ["chapter_title", "-year"]},           # filter keys: see question_bank
+#       {"output": "all.pdf", "dedup": "collapse", "dedup_similarity": 0.8},   # see dedup.py
+#       {"output": "compact.pdf", "pack": true},     # reorder within topics to save pages
+#       ...
+#     ]
+#   }
+# A bare list is accepted as the "booklets" entry on its own.
+
+def load_manifest(path):
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {"booklets": manifest}
+    base = os.path.dirname(os.path.abspath(path))
+    if manifest.get("questions"):
+        source = os.path.join(base, manifest["questions"])
+        if source.lower().endswith(".json"):
+            with open(source, encoding="utf-8") as f:
+                manifest["questions"] = json.load(f)
         else:
-            # question has parts -> list each part on its own row and attempt to extract per-part marks
-            first_row = True
-            for part_key in sorted(q.get("answer_text", {}).keys()):
-                ans = tidy_text_for_math(q["answer_text"][part_key])
-                para = Paragraph(ans, normal_style)
-                marks_part = "-"
-                # best-effort: find "[n]" immediately after the (part) text in the question body
-                m = re.search(rf'\({re.escape(part_key)}\)[^\[]*\[(\d+)\]', tidy_text_for_math(q.get("question_text","")), flags=re.IGNORECASE)
-                if m:
-                    marks_part = int(m.group(1))
-                if first_row:
-                    table_rows.append([f"{q.get('question_number')}", f"({part_key})", marks_part, para])
-                    first_row = False
-                else:
-                    table_rows.append(["", f"({part_key})", marks_part, para])
+            # banks are opened inside each worker, which then reads only its selected rows
+            manifest["questions"] = source
+    else:
+        manifest["questions"] = SAMPLE_QUESTIONS
+    for spec in manifest["booklets"]:
+        spec["output"] = os.path.join(base, spec["output"])
+        if manifest.get("parse_cache"):
+            spec.setdefault("parse_cache", os.path.join(base, manifest["parse_cache"]))
+    return manifest
+
+# Set once per worker process by the pool initializer: either an index over a
+# list of records (pickled and indexed once per worker instead of once per
+# booklet) or an opened question bank.
+_batch_questions = None
+
+def _init_batch_worker(questions):
+    global _batch_questions
+    _batch_questions = open_bank(questions) if isinstance(questions, str) else QuestionIndex(questions)
+
+def select_questions(source, filters, order_by=None):
+    """Records from a list, a QuestionIndex or a question bank (see question_bank.open_bank)
+    matching filters, sorted by order_by."""
+    if hasattr(source, "select"):
+        return source.select(filters, order_by)
+    return sort_questions(filter_questions(source, filters), order_by)
+
+def dedup_selection(questions, mode="collapse", similarity=None):
+    """dedup.dedup_questions, comparing question text as it is printed (after tidy_text_for_math)."""
+    with instr.span("dedup", questions=len(questions)):
+        kept, repeats = dedup_questions(questions, mode, similarity,
+                                        text=lambda q: tidy_text_for_math(q.get("question_text") or ""))
+    instr.count("duplicates", len(repeats))
+    return kept, repeats
+
+def pack_selection(questions):
+    """pack_questions over selected records; returns (Questions, pages saved)."""
+    with instr.span("pack", questions=len(questions)):
+        return pack_questions(normalize_questions(questions))
+
+def _build_spec(spec):
+    t0 = time.perf_counter()
+    result = {"output": spec["output"]}
+    try:
+        selected = select_questions(_batch_questions, spec.get("filters"), spec.get("order_by"))
+        if spec.get("dedup"):
+            selected, repeats = dedup_selection(selected, spec["dedup"], spec.get("dedup_similarity"))
+            result["duplicates"] = len(repeats)
+        if not selected:
+            raise ValueError("no questions match filters")
+        if spec.get("pack"):
+            selected, result["pages_saved"] = pack_selection(selected)
+        output_cache = OutputCache(spec["output_cache"]) if spec.get("output_cache") else None
+        builder = BookletBuilder(selected, spec["output"], title=spec.get("title") or DEFAULT_TITLE,
+                                 parse_cache=spec.get("parse_cache"), output_cache=output_cache)
+        builder.build()
+        result.update(ok=True, pages=builder.layout.page_count, questions=len(selected), cached=builder.from_cache,
+                      page_map=builder.layout.page_map())
+    except Exception as e:
+        result.update(ok=False, error=f"{type(e).__name__}: {e}")
+    result["seconds"] = time.perf_counter() - t0
+    return result
 
-    # Table drawing: give a dedicated start; if it doesn't fit, start a new page and draw there.
-    col_widths = [2.0*cm, 2.0*cm, 2.0*cm, content_width - 6.0*cm]
-    tbl = Table(table_rows, colWidths=col_widths, repeatRows=1)
-    tbl.setStyle(TableStyle([
-        ("FONT", (0,0), (-1,0), "Helvetica-Bold", 10),
-        ("BACKGROUND", (0,0), (-1,0), colors.lightgrey),
-        ("VALIGN", (0,0), (-1,-1), "TOP"),
-        ("GRID", (0,0), (-1,-1), 0.5, colors.black),
-        ("LEFTPADDING", (0,0), (-1,-1), 6),
-        ("RIGHTPADDING", (0,0), (-1,-1), 6),
-        ("TOPPADDING", (0,0), (-1,-1), 6),
-        ("BOTTOMPADDING", (0,0), (-1,-1), 6),
-    ]))
-
-    # wrap the table to see if it fits on the current page under the header area
-    w_tbl, h_tbl = tbl.wrapOn(c, content_width, height)
-    available = y - bottom_margin - 20
-    if h_tbl > available:
-        # not enough space: start a fresh page for this table
-        finish_page(start_new=True, force=True)
-        # header for table continuation (marks this new page as content)
-        c.setFont("Helvetica-Bold", 14)
-        y = height - top_margin - 36
-        c.drawString(left_margin, y, topic + " — Marking Scheme (cont.)")
-        y -= 20
-        page_has_content = True
-        w_tbl, h_tbl = tbl.wrapOn(c, content_width, height)
-
-    # draw table on the current page
-    tbl.drawOn(c, left_margin, y - h_tbl)
-    page_has_content = True
-
-    # After finishing a topic MS, force a page break so the next topic's MS starts on its own page.
-    finish_page(start_new=True, force=True)
-
-# Final footer on last page (do not add spurious pages)
-finish_page(start_new=False)   # draw footer if needed, but do NOT create a new page
-c.save()
-
-# Print simulation vs actual maps for you to inspect
-print("--- SIMULATION RESULTS (reprinted) ---")
-print("Simulated topic divider pages:", topic_divider_pages)
-print("Simulated topic MS start pages:", topic_ms_start_pages)
-print("Simulated MS divider page:", ms_divider_page)
-print("--- ACTUAL (render-time) RESULTS ---")
-print("Actual topic divider pages:", actual_topic_divider_pages)
-print("Actual topic MS start pages:", actual_topic_ms_start_pages)
-print("Actual MS divider page:", ms_divider_actual_page)
-print("Done — PDF written to:", filepath)
+def run_batch(specs, questions, workers=None):
+    """Build every spec across a process pool; returns one result dict per spec, in manifest order.
+
+    Each result has "output", "ok" and "seconds", plus "pages"/"questions"/"page_map" on
+    success or "error" on failure.  A failing booklet never stops the others.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    results = [None] * len(specs)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=(questions,)) as pool:
+        futures = {pool.submit(_build_spec, spec): i for i, spec in enumerate(specs)}
+        for fut in as_completed(futures):
+            i = futures[fut]
+            try:
+                results[i] = fut.result()
+            except Exception as e:
+                # the worker itself died (e.g. BrokenProcessPool); no timing available
+                results[i] = {"output": specs[i]["output"], "ok": False,
+                              "error": f"{type(e).__name__}: {e}", "seconds": 0.0}
+    return results
+
+def print_batch_report(results):
+    for r in results:
+        if r["ok"]:
+            print(f"OK    {r['seconds']:7.2f}s  {r['pages']:4d} pages  {r['output']}{' (cached)' if r.get('cached') else ''}")
+        else:
+            print(f"FAIL  {r['seconds']:7.2f}s              {r['output']}: {r['error']}")
+    failed = sum(1 for r in results if not r["ok"])
+    print(f"Batch done — {len(results) - failed} built, {failed} failed")
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Build a topical past-paper booklet PDF.")
+    parser.add_argument("-o", "--output", default=os.path.join(os.getcwd(), DEFAULT_OUTPUT_FILENAME),
+                        help="output PDF path (default: %(default)s)")
+    parser.add_argument("--bank", help="question bank to build from (.jsonl/.ndjson or .db/.sqlite); default: sample questions")
+    parser.add_argument("--topic", action="append", help="only include this chapter_title (repeatable)")
+    parser.add_argument("--series", action="append", help="only include this exam_series (repeatable)")
+    parser.add_argument("--year", action="append", type=int, help="only include this exam year (repeatable)")
+    parser.add_argument("--paper", action="append", help="only include this paper code, e.g. 22 (repeatable)")
+    parser.add_argument("--min-marks", type=int, help="only include questions worth at least this many marks")
+    parser.add_argument("--max-marks", type=int, help="only include questions worth at most this many marks")
+    parser.add_argument("--dedup", choices=("collapse", "flag"),
+                        help="drop (collapse) or just list (flag) questions repeated across series")
+    parser.add_argument("--dedup-similarity", type=float, metavar="J",
+                        help="also treat near-identical wording as a repeat (Jaccard similarity, e.g. 0.8)")
+    parser.add_argument("--pack", action="store_true",
+                        help="reorder questions within each topic to fill pages (end_of_topic breaks are kept)")
+    parser.add_argument("--sort", metavar="FIELDS",
+                        help="comma-separated sort fields, '-' for descending (e.g. chapter_title,-year,marks)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="reuse cached renders of unchanged topics (needs pypdf)")
+    parser.add_argument("--stream", action="store_true",
+                        help="flush finished pages to disk while building to bound memory")
+    parser.add_argument("--chunk-pages", type=int, default=50, help="pages per flushed chunk with --stream")
+    parser.add_argument("--parse-cache", metavar="PATH", help="keep parsed questions in this file between runs")
+    parser.add_argument("--output-cache", metavar="DIR", default=DEFAULT_OUTPUT_CACHE_DIR,
+                        help="reuse finished booklets whose questions and layout are unchanged (default: %(default)s)")
+    parser.add_argument("--no-output-cache", action="store_true", help="always rebuild")
+    parser.add_argument("--batch", metavar="MANIFEST", help="build every booklet listed in a JSON manifest")
+    parser.add_argument("--parallel", action="store_true", help="render the topics in worker processes")
+    parser.add_argument("--workers", type=int,
+                        help="worker processes for --batch/--parallel (default: manifest or CPU count)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the booklet's page numbers without rendering or writing a PDF")
+    parser.add_argument("--page-map", action="store_true", help="like --dry-run, but print the page map as JSON")
+    parser.add_argument("--log-level", choices=("off", "info", "debug"), default="off",
+                        help="info: per-stage timings and counters on stderr; debug: also per-page messages")
+    parser.add_argument("--json-log", metavar="PATH", help="write stage/debug events as JSON lines")
+    parser.add_argument("--chrome-trace", metavar="PATH", help="write a trace for chrome://tracing or Perfetto")
+    parser.add_argument("--profile", metavar="PATH", help="write a cProfile dump of the build")
+    args = parser.parse_args(argv)
+
+    instr.configure(args.log_level, args.json_log, args.chrome_trace, args.profile)
+    try:
+        return _run(args)
+    finally:
+        instr.close()
+
+
+def _run(args):
+    if args.batch:
+        manifest = load_manifest(args.batch)
+        if not args.no_output_cache:
+            for spec in manifest["booklets"]:
+                spec.setdefault("output_cache", args.output_cache)
+        results = run_batch(manifest["booklets"], manifest["questions"], args.workers or manifest.get("workers"))
+        print_batch_report(results)
+        return 1 if any(not r["ok"] for r in results) else 0
+
+    filters = {}
+    if args.topic:
+        filters["chapter_title"] = args.topic
+    if args.series:
+        filters["exam_series"] = args.series
+    if args.year:
+        filters["year"] = args.year
+    if args.paper:
+        filters["paper"] = args.paper
+    if args.min_marks is not None:
+        filters["min_marks"] = args.min_marks
+    if args.max_marks is not None:
+        filters["max_marks"] = args.max_marks
+    order_by = args.sort.split(",") if args.sort else None
+    if args.bank:
+        bank = open_bank(args.bank)
+        questions = bank.select(filters, order_by)
+        bank.close()
+    else:
+        questions = select_questions(SAMPLE_QUESTIONS, filters, order_by)
+    if args.dedup or args.dedup_similarity is not None:
+        selected, mode = questions, args.dedup or "collapse"
+        questions, repeats = dedup_selection(selected, mode, args.dedup_similarity)
+        if mode == "flag":
+            for pos, first in sorted(repeats.items()):
+                print(f"Duplicate: {selected[pos].get('original_ref')} repeats {selected[first].get('original_ref')}")
+        print(f"Duplicates: {len(repeats)} {'dropped' if mode == 'collapse' else 'flagged'}")
+    if not questions:
+        print("No questions match the selection.")
+        return 1
+    if args.pack:
+        questions, saved = pack_selection(questions)
+        print(f"Packing: {saved} pages saved")
+
+    if args.dry_run or args.page_map:
+        # layout core only: no canvas, platypus or image downloads; MS/TOC rows
+        # are measured with paragraph_line_count
+        pm = page_map(normalize_questions(questions))
+        if args.page_map:
+            print(json.dumps(pm, ensure_ascii=False, indent=2))
+        else:
+            print("Topic divider pages:", pm["topic_divider_pages"])
+            print("Topic MS start pages:", pm["topic_ms_start_pages"])
+            print("MS divider page:", pm["ms_divider_page"])
+            print("Pages:", pm["page_count"])
+        return 0
+
+    output_cache = None if args.no_output_cache or args.incremental else OutputCache(args.output_cache)
+    builder = BookletBuilder(questions, args.output, parse_cache=args.parse_cache, output_cache=output_cache)
+    if args.stream:
+        builder.build_streaming(args.chunk_pages)
+    elif args.parallel:
+        builder.build_parallel(args.workers)
+    elif args.incremental:
+        reused, rendered = builder.build_incremental()
+        print(f"Incremental: {reused} topic fragments reused, {rendered} rendered")
+    else:
+        builder.build()
+    layout = builder.layout
+    if builder.from_cache:
+        print("Unchanged since the last build: copied from the output cache")
+    print("Topic divider pages:", layout.topic_divider_pages)
+    print("Topic MS start pages:", layout.topic_ms_start_pages)
+    print("MS divider page:", layout.ms_divider_page)
+    print("Pages:", layout.page_count)
+    print("Done — PDF written to:", builder.output)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,404 @@
+# image_cache.py
+# Prefetch stage for question figures: every URL a booklet needs is fetched up
+# front, concurrently, into a content-addressed on-disk cache that is shared by
+# all builds (and all booklets) on the machine.  prepare_images() then downscales
+# each figure once to the box it is drawn in, so reportlab never has to decode the
+# full-resolution source; those copies are aged out and size-bounded like the
+# output cache (evict_prepared).
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os, json, hashlib, threading, time, tempfile
+from urllib.parse import urlparse
+
+CACHE_ROOT = os.path.join(os.path.expanduser("~"), ".cache", "physics-past-paper")
+DEFAULT_CACHE_DIR = os.path.join(CACHE_ROOT, "images")
+DEFAULT_PREPARED_DIR = os.path.join(CACHE_ROOT, "prepared")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+FETCH_TIMEOUT = 15
+DEFAULT_IMAGE_DPI = 200
+JPEG_QUALITY = 85
+EVICT_GRACE = 600
+DEFAULT_PREPARED_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_PREPARED_MAX_AGE = 30 * 24 * 3600
+
+
+# read once: os.umask() can only be queried by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def is_url(ref):
+    return urlparse(str(ref)).scheme in ("http", "https")
+
+
+def replace_file(tmp, path):
+    """os.replace a finished mkstemp file onto path, first giving it the mode a plain
+    open() would have (mkstemp creates 0600, which hides shared caches from other users)."""
+    os.chmod(tmp, 0o666 & ~_UMASK)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def file_lock(path, timeout=30, stale=120):
+    """Hold <path>.lock for a read-merge-write of path shared between processes.
+
+    A lock older than stale seconds was left by a crashed process and is
+    broken; after timeout seconds the caller goes ahead unlocked rather than
+    failing the build over a cache file.
+    """
+    lock = path + ".lock"
+    deadline = time.monotonic() + timeout
+    owned = False
+    while not owned:
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            owned = True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > stale:
+                    os.remove(lock)
+                    continue
+            except OSError:
+                continue
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        if owned:
+            try:
+                os.remove(lock)
+            except OSError:
+                pass
+
+
+class ImageCache:
+    """Content-addressed image store with size-based LRU eviction.
+
+    Objects are named by the SHA-256 of their bytes, so the same figure used by
+    several questions (or reachable from several URLs) is stored once.  index.json
+    maps each URL to its object plus the ETag / Last-Modified validators used to
+    revalidate it with a conditional GET on the next build.  Several builds may
+    share the directory, so save() merges this process's changes into the index
+    on disk (under a lock file) rather than overwriting it.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = self._load_index()
+        self._changed_urls = set()
+        self._changed_objects = set()
+
+    # ---------- index ----------
+    def _load_index(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        index.setdefault("urls", {})
+        index.setdefault("objects", {})
+        return index
+
+    def save(self, keep=()):
+        """Merge this process's changes into index.json and evict down to max_bytes.
+
+        Objects named in keep (the figures the current build resolved) are never
+        evicted, nor is anything used in the last EVICT_GRACE seconds, which covers
+        concurrent builds that have fetched but not yet prepared their figures.
+        """
+        with file_lock(self.index_path):
+            index = self._load_index()
+            with self._lock:
+                for url in self._changed_urls:
+                    index["urls"][url] = self._index["urls"][url]
+                for name in self._changed_objects:
+                    meta = self._index["objects"][name]
+                    other = index["objects"].get(name)
+                    index["objects"][name] = dict(meta, atime=max(meta["atime"], other["atime"])) if other else meta
+                self._changed_urls.clear()
+                self._changed_objects.clear()
+                self._index = index
+                self._adopt_orphans()
+                self._evict(set(keep))
+                data = json.dumps(self._index)
+            # atomic replace so concurrent builds never read a half-written index
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+            replace_file(tmp, self.index_path)
+
+    def _object_path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _adopt_orphans(self):
+        # objects whose index entry was lost (e.g. by an older build's overwrite)
+        # still count towards max_bytes; ones deleted by another build are dropped
+        objects = self._index["objects"]
+        on_disk = set()
+        for name in os.listdir(self.cache_dir):
+            if name == "index.json" or name.endswith((".tmp", ".lock")):
+                continue
+            on_disk.add(name)
+            if name not in objects:
+                try:
+                    st = os.stat(self._object_path(name))
+                except OSError:
+                    continue
+                objects[name] = {"size": st.st_size, "atime": st.st_mtime}
+        for name in [n for n in objects if n not in on_disk]:
+            del objects[name]
+
+    def _evict(self, keep=frozenset()):
+        objects = self._index["objects"]
+        total = sum(o["size"] for o in objects.values())
+        if total <= self.max_bytes:
+            return
+        recent = time.time() - EVICT_GRACE
+        for name, meta in sorted(objects.items(), key=lambda kv: kv[1]["atime"]):
+            if total <= self.max_bytes or meta["atime"] > recent:
+                break
+            if name in keep:
+                continue
+            try:
+                os.remove(self._object_path(name))
+            except OSError:
+                pass
+            total -= meta["size"]
+            del objects[name]
+        urls = self._index["urls"]
+        for url in [u for u, entry in urls.items() if entry["object"] not in objects]:
+            del urls[url]
+
+    # ---------- lookups ----------
+    def _cached(self, url):
+        """Return (index entry, object path) for url if its object is still on disk."""
+        with self._lock:
+            entry = self._index["urls"].get(url)
+        if entry and os.path.exists(self._object_path(entry["object"])):
+            return entry, self._object_path(entry["object"])
+        return None, None
+
+    def _touch(self, name):
+        with self._lock:
+            meta = self._index["objects"].get(name)
+            if meta:
+                meta["atime"] = time.time()
+                self._changed_objects.add(name)
+
+    def _store(self, url, content, response):
+        digest = hashlib.sha256(content).hexdigest()
+        ext = os.path.splitext(urlparse(url).path)[1] or ".img"
+        name = digest + ext
+        path = self._object_path(name)
+        if not os.path.exists(path):
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            replace_file(tmp, path)
+        with self._lock:
+            self._index["objects"][name] = {"size": len(content), "atime": time.time()}
+            self._index["urls"][url] = {
+                "object": name,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            self._changed_urls.add(url)
+            self._changed_objects.add(name)
+        return path
+
+    def fetch(self, url, session):
+        """Return a local path for url, revalidating a cached copy if there is one."""
+        entry, path = self._cached(url)
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            r = session.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+            if r.status_code == 304 and path:
+                self._touch(entry["object"])
+                return path
+            r.raise_for_status()
+            return self._store(url, r.content, r)
+        except Exception as e:
+            if path:
+                # offline or server error: a stale copy beats a missing figure
+                print("Image revalidation failed, using cached copy:", e)
+                self._touch(entry["object"])
+                return path
+            print("Image download error:", e)
+            return None
+
+
+def prefetch_images(refs, cache=None, workers=8):
+    """Resolve every image reference to a local path before rendering.
+
+    refs may mix local paths and http(s) URLs; duplicates are fetched once.
+    Returns {ref: local path or None}.
+    """
+    resolved = {}
+    urls = []
+    for ref in dict.fromkeys(r for r in refs if r):
+        if os.path.exists(ref):
+            resolved[ref] = ref
+        elif is_url(ref):
+            urls.append(ref)
+        else:
+            print("Image not found:", ref)
+            resolved[ref] = None
+    if not urls:
+        return resolved
+
+    # imported here so builds without URL figures never load the HTTP stack
+    import requests
+    cache = cache or ImageCache()
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        with ThreadPoolExecutor(max_workers=min(workers, len(urls))) as pool:
+            for url, path in zip(urls, pool.map(lambda u: cache.fetch(u, session), urls)):
+                resolved[url] = path
+    cache.save(keep={os.path.basename(resolved[u]) for u in urls if resolved[u]})
+    return resolved
+
+
+# -------------------------
+# Image preparation (downscale once, pick JPEG or Flate)
+# -------------------------
+_digest_memo = {}
+_digest_lock = threading.Lock()
+
+def file_digest(path):
+    """SHA-256 of a file's bytes, memoized on (path, size, mtime) for this process."""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        if key in _digest_memo:
+            return _digest_memo[key]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _digest_lock:
+        _digest_memo[key] = digest
+    return digest
+
+def _wants_flate(img):
+    # line art, greyscale diagrams, palettes and anything with transparency compress
+    # better (and stay sharp) losslessly; photographic scans go to JPEG
+    if img.mode in ("1", "L", "LA", "P", "RGBA", "PA"):
+        return True
+    return img.getcolors(256) is not None
+
+def prepare_image(path, box_w, box_h, dpi=DEFAULT_IMAGE_DPI, cache_dir=DEFAULT_PREPARED_DIR):
+    """Return a copy of the image at path sized for a box_w x box_h point box at dpi.
+
+    The result is cached under cache_dir keyed by source hash, box size and dpi, so
+    repeat builds skip decoding.  Images already small enough are returned as-is;
+    undecodable files return None.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return path
+    max_px = (max(1, round(box_w / 72.0 * dpi)), max(1, round(box_h / 72.0 * dpi)))
+    try:
+        key = f"{file_digest(path)}_{max_px[0]}x{max_px[1]}"
+    except OSError as e:
+        # evicted or deleted since prefetch: treat it like any other missing figure
+        print("Image not found:", path, e)
+        return None
+    for ext in (".jpg", ".png"):
+        cached = os.path.join(cache_dir, key + ext)
+        try:
+            os.utime(cached)   # the mtime is the last use, for evict_prepared
+            return cached
+        except OSError:
+            pass
+    try:
+        with Image.open(path) as img:
+            if img.width <= max_px[0] and img.height <= max_px[1]:
+                return path
+            img.thumbnail(max_px, Image.LANCZOS)
+            if _wants_flate(img):
+                ext, fmt, opts = ".png", "PNG", {"optimize": True}
+            else:
+                ext, fmt, opts = ".jpg", "JPEG", {"quality": JPEG_QUALITY, "optimize": True}
+                img = img.convert("RGB")
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    img.save(f, fmt, **opts)
+                out = os.path.join(cache_dir, key + ext)
+                replace_file(tmp, out)
+            except BaseException:
+                os.remove(tmp)
+                raise
+    except Exception as e:
+        print("Image preparation error:", path, e)
+        return None
+    return out
+
+def evict_prepared(cache_dir=DEFAULT_PREPARED_DIR, max_bytes=DEFAULT_PREPARED_MAX_BYTES,
+                   max_age=DEFAULT_PREPARED_MAX_AGE, keep=()):
+    """Drop prepared images unused for max_age seconds, then the least recently used
+    until the directory is under max_bytes (as OutputCache does for booklets).
+
+    Paths in keep, and anything used in the last EVICT_GRACE seconds, stay; .tmp
+    files that old were left by a crashed build and go regardless.
+    """
+    now = time.time()
+    keep = {os.path.abspath(p) for p in keep if p}
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if name.endswith(".tmp"):
+            if now - st.st_mtime > EVICT_GRACE:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if now - mtime <= max_age and total <= max_bytes:
+            continue
+        if now - mtime <= EVICT_GRACE or os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def prepare_images(resolved, box_w, box_h, dpi=DEFAULT_IMAGE_DPI, cache_dir=DEFAULT_PREPARED_DIR):
+    """Map prefetch_images() output through prepare_image(); missing images stay None.
+
+    The prepared-image directory is then evicted down to its bounds, sparing
+    this build's images.
+    """
+    prepared = {ref: prepare_image(path, box_w, box_h, dpi, cache_dir) if path else None
+                for ref, path in resolved.items()}
+    evict_prepared(cache_dir, keep=prepared.values())
+    return prepared
@@ -0,0 +1,140 @@
+# instrument.py
+# Structured instrumentation for booklet builds: per-stage spans, counters and
+# debug messages, with optional sinks (JSON-lines log, Chrome trace, cProfile).
+#
+# Disabled by default.  When disabled, span() hands back a shared no-op context
+# manager and count() returns after one attribute check; hot loops guard their
+# debug messages with `if instr.debug_on:` so the message isn't even formatted.
+
+import json, os, sys, threading, time
+
+OFF, INFO, DEBUG = 0, 1, 2
+LEVELS = {"off": OFF, "info": INFO, "debug": DEBUG}
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("inst", "name", "args", "t0")
+
+    def __init__(self, inst, name, args):
+        self.inst = inst
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.inst._record_span(self.name, self.t0, time.perf_counter(), self.args)
+        return False
+
+
+class Instrumentation:
+    def __init__(self):
+        self.level = OFF
+        self.enabled = False
+        self.debug_on = False
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._json_log = None
+        self._chrome_trace = None
+        self._trace_events = []
+        self._stage_totals = {}
+        self._profile_path = None
+        self._profiler = None
+
+    def configure(self, level="off", json_log=None, chrome_trace=None, profile=None):
+        """Turn instrumentation on.
+
+        level: "off" | "info" (stage summary on stderr at close) | "debug" (plus
+        per-page/per-question messages).  json_log: path of a JSON-lines event
+        log.  chrome_trace: path of a trace viewable in chrome://tracing or
+        Perfetto.  profile: path of a cProfile dump (profiles the calling thread).
+        """
+        self.close()
+        self.level = LEVELS[level] if isinstance(level, str) else level
+        self.debug_on = self.level >= DEBUG
+        self._json_log = open(json_log, "w", encoding="utf-8") if json_log else None
+        self._chrome_trace = chrome_trace
+        self._profile_path = profile
+        self.enabled = self.level > OFF or bool(json_log or chrome_trace or profile)
+        if profile:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    # ---------- recording ----------
+    def span(self, name, **args):
+        """Context manager timing one stage; args are attached to the event."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def debug(self, msg, page=None):
+        """Debug message; callers check `instr.debug_on` first."""
+        print(f"DEBUG [page {page if page is not None else '?'}]: {msg}", file=sys.stderr)
+        self._log({"event": "debug", "page": page, "msg": msg})
+
+    def _log(self, event):
+        if self._json_log:
+            event["t"] = round(time.perf_counter() - self._origin, 6)
+            line = json.dumps(event, ensure_ascii=False)
+            with self._lock:
+                self._json_log.write(line + "\n")
+
+    def _record_span(self, name, t0, t1, args):
+        with self._lock:
+            self._stage_totals[name] = self._stage_totals.get(name, 0.0) + (t1 - t0)
+            if self._chrome_trace:
+                self._trace_events.append({
+                    "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                    "ts": (t0 - self._origin) * 1e6, "dur": (t1 - t0) * 1e6, "args": args,
+                })
+        self._log({"event": "span", "name": name, "seconds": round(t1 - t0, 6), **args})
+
+    # ---------- output ----------
+    def summary(self):
+        with self._lock:
+            return {"stages": dict(self._stage_totals), "counters": dict(self.counters)}
+
+    def close(self):
+        """Flush every sink and return to the disabled state."""
+        if self._profiler:
+            self._profiler.disable()
+            self._profiler.dump_stats(self._profile_path)
+            self._profiler = None
+        if self.enabled:
+            summary = self.summary()
+            self._log({"event": "summary", **summary})
+            if self.level >= INFO:
+                for name, secs in summary["stages"].items():
+                    print(f"stage {name:<24} {secs:9.3f}s", file=sys.stderr)
+                for name, n in summary["counters"].items():
+                    print(f"count {name:<24} {n:9d}", file=sys.stderr)
+        if self._chrome_trace:
+            with open(self._chrome_trace, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": self._trace_events}, f)
+        if self._json_log:
+            self._json_log.close()
+        self.__init__()
+
+
+# process-wide instance used by the builder
+instr = Instrumentation()
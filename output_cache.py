@@ -0,0 +1,85 @@
+# output_cache.py
+# Finished booklets, stored under the hash of everything that determines them
+# (question records, title, layout constants and render version, figure bytes;
+# see generate_pdf.booklet_key).
+# A rebuild of an unchanged booklet is then a file copy.
+#
+# Each entry is <key>.pdf plus <key>.json holding the page map, so callers still
+# get topic and marking-scheme page numbers without laying anything out.  Entry
+# mtimes double as last-use times: entries unused for max_age seconds are
+# dropped, and the least recently used go first when the total exceeds max_bytes.
+
+import os, json, shutil, tempfile, time
+
+from image_cache import CACHE_ROOT, replace_file
+
+DEFAULT_OUTPUT_CACHE_DIR = os.path.join(CACHE_ROOT, "output")
+DEFAULT_OUTPUT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_OUTPUT_MAX_AGE = 30 * 24 * 3600
+
+
+class OutputCache:
+    def __init__(self, cache_dir=DEFAULT_OUTPUT_CACHE_DIR, max_bytes=DEFAULT_OUTPUT_MAX_BYTES,
+                 max_age=DEFAULT_OUTPUT_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + ".pdf", base + ".json"
+
+    def get(self, key):
+        """Return (pdf path, page map) for key, or None on a miss (or an expired entry)."""
+        pdf, meta = self._paths(key)
+        try:
+            if time.time() - os.path.getmtime(pdf) > self.max_age:
+                return None
+            with open(meta, encoding="utf-8") as f:
+                page_map = json.load(f)
+            os.utime(pdf)
+            os.utime(meta)
+        except (OSError, ValueError):
+            return None
+        return pdf, page_map
+
+    def put(self, key, src, page_map, evict=True):
+        """Copy the finished PDF at src into the cache with its page map, then evict
+        (unless evict is False: the caller runs evict() once it no longer needs its entries)."""
+        pdf, meta = self._paths(key)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(src, tmp)
+        replace_file(tmp, pdf)
+        # the page map goes in last: get() treats an entry without one as a miss
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(page_map, f)
+        replace_file(tmp, meta)
+        if evict:
+            self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".pdf"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name[:-4]))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, key in entries:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                continue
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
@@ -0,0 +1,215 @@
+# pdf_concat.py
+# Streaming concatenation of PDFs written by reportlab's Canvas.
+#
+# General-purpose PDF libraries load every page object of every input before
+# writing, so their memory grows with the booklet.  reportlab always writes a
+# plain file (classic xref table, one flat /Pages node, no object streams), so
+# its output can be merged by copying one object at a time: renumber the object
+# references in each object's dictionary, copy its stream bytes unchanged, and
+# write a new catalog and page tree at the end.  Memory stays flat however
+# many pages are merged.
+#
+# Each input embeds its own copy of every font, form and image it uses.  These
+# resources (with the descriptors, font files and dictionaries they reference)
+# are hashed by content, and one already written by an earlier input is
+# pointed at instead of copied again.  Pieces of one booklet are seeded to
+# embed identical font subsets (fonts.seed_subsets), so the merged file
+# carries each face once, as a single-canvas build does.
+
+import hashlib, re
+
+_REF = re.compile(rb"(\d+) 0 R")
+_STREAM = re.compile(rb"stream\r?\n")
+_RESOURCE = re.compile(rb"/Type\s*/Font(?:Descriptor)?\b|/Subtype\s*/(?:Form|Image)\b")
+_COPY_CHUNK = 1 << 16
+_HEAD = 1024
+
+
+class _Output:
+    """Byte-counting wrapper so object offsets are known without seeking."""
+    def __init__(self, f):
+        self.f = f
+        self.pos = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.pos += len(data)
+
+
+def _read_xref(f):
+    """Return ({object number: offset}, xref offset, trailer bytes) for a classic-xref PDF."""
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(max(0, size - 2048))
+    tail = f.read()
+    m = re.search(rb"startxref\s+(\d+)", tail)
+    if not m:
+        raise ValueError("no startxref found")
+    xref_pos = int(m.group(1))
+    f.seek(xref_pos)
+    if f.readline().strip() != b"xref":
+        raise ValueError("not a classic xref table (only reportlab-written PDFs are supported)")
+    offsets = {}
+    line = f.readline()
+    while line.strip() and line.strip() != b"trailer":
+        first, count = (int(x) for x in line.split())
+        for num in range(first, first + count):
+            entry = f.readline().split()
+            if entry[2] == b"n":
+                offsets[num] = int(entry[0])
+        line = f.readline()
+    trailer = f.read(2048)
+    return offsets, xref_pos, trailer
+
+
+def _read_object(f, offsets, ends, num, limit=_COPY_CHUNK):
+    f.seek(offsets[num])
+    return f.read(min(limit, ends[num] - offsets[num]))
+
+
+def _read_parts(f, offsets, ends, num):
+    """(dictionary bytes, hash of the stream and everything after it) of object num."""
+    f.seek(offsets[num])
+    remaining = ends[num] - offsets[num]
+    head = f.read(min(_COPY_CHUNK, remaining))
+    remaining -= len(head)
+    body_start = head.index(b"obj") + 3
+    m = _STREAM.search(head, body_start)
+    if not m and remaining:
+        head += f.read(remaining)
+        remaining = 0
+    dict_part, stream_part = (head[body_start:m.end()], head[m.end():]) if m else (head[body_start:], b"")
+    h = hashlib.blake2b(stream_part, digest_size=20)
+    while remaining:
+        chunk = f.read(min(_COPY_CHUNK, remaining))
+        remaining -= len(chunk)
+        h.update(chunk)
+    return dict_part, h.digest()
+
+
+def _resource_digests(f, offsets, ends, order):
+    """{object number: content hash} for the shared resources of one input.
+
+    Fonts, font descriptors and XObjects (forms, images) are hashed together
+    with everything they reference, so equal hashes mean interchangeable
+    objects.  Objects in a reference cycle, or referring to a missing object,
+    get no hash and are always copied.
+    """
+    todo = []
+    for num in order:
+        f.seek(offsets[num])
+        head = f.read(min(_HEAD, ends[num] - offsets[num]))
+        m = _STREAM.search(head)
+        if _RESOURCE.search(head[:m.start()] if m else head):
+            todo.append(num)
+    parts = {}
+    while todo:
+        num = todo.pop()
+        if num in parts or num not in offsets:
+            continue
+        parts[num] = _read_parts(f, offsets, ends, num)
+        todo.extend(int(n) for n in _REF.findall(parts[num][0]))
+
+    digests = {}
+    def digest(num):
+        if num not in digests:
+            digests[num] = None   # stays None inside a cycle
+            if num in parts:
+                dict_part, stream_hash = parts[num]
+                refs = [digest(int(n)) for n in _REF.findall(dict_part)]
+                if None not in refs:
+                    refs = iter(refs)
+                    h = hashlib.blake2b(_REF.sub(lambda m: b"<%s>" % next(refs), dict_part), digest_size=20)
+                    h.update(stream_hash)
+                    digests[num] = h.hexdigest().encode("ascii")
+        return digests[num]
+    for num in parts:
+        digest(num)
+    return {num: d for num, d in digests.items() if d is not None}
+
+
+def concat_pdfs(paths, out):
+    """Concatenate reportlab-written PDFs at paths into out (a path or a binary file)."""
+    if not hasattr(out, "write"):
+        with open(out, "wb") as f:
+            return concat_pdfs(paths, f)
+
+    w = _Output(out)
+    w.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    # objects 1 and 2 are the new catalog and page tree, written last
+    new_offsets = {}
+    next_num = 3
+    kids = []
+    written = {}   # resource content hash -> object number in out
+
+    for path in paths:
+        with open(path, "rb") as f:
+            offsets, xref_pos, trailer = _read_xref(f)
+            order = sorted(offsets, key=offsets.get)
+            ends = {num: (offsets[order[i + 1]] if i + 1 < len(order) else xref_pos) for i, num in enumerate(order)}
+
+            root = int(re.search(rb"/Root (\d+) 0 R", trailer).group(1))
+            info = re.search(rb"/Info (\d+) 0 R", trailer)
+            catalog = _read_object(f, offsets, ends, root)
+            pages = int(re.search(rb"/Pages (\d+) 0 R", catalog).group(1))
+            page_tree = _read_object(f, offsets, ends, pages, limit=ends[pages] - offsets[pages])
+            kid_nums = [int(n) for n in _REF.findall(page_tree[page_tree.index(b"/Kids"):].split(b"]")[0])]
+
+            # the catalog, its page tree, outlines and the info dict are replaced by ours
+            dropped = {root, pages} | {int(n) for n in _REF.findall(catalog)}
+            if info:
+                dropped.add(int(info.group(1)))
+            renumber = {pages: 2}
+            shared = set()
+            digests = _resource_digests(f, offsets, ends, order)
+            for num in order:
+                if num in dropped:
+                    continue
+                if digests.get(num) in written:
+                    renumber[num] = written[digests[num]]
+                    shared.add(num)
+                    continue
+                renumber[num] = next_num
+                if num in digests:
+                    written[digests[num]] = next_num
+                next_num += 1
+            kids.extend(renumber[n] for n in kid_nums)
+
+            def sub_ref(m):
+                return b"%d 0 R" % renumber.get(int(m.group(1)), 0)
+
+            for num in order:
+                if num in dropped or num in shared:
+                    continue
+                f.seek(offsets[num])
+                remaining = ends[num] - offsets[num]
+                head = f.read(min(_COPY_CHUNK, remaining))
+                remaining -= len(head)
+                body_start = head.index(b"obj") + 3
+                m = _STREAM.search(head, body_start)
+                if not m and remaining:
+                    # large stream-less object: its references must all be rewritten
+                    head += f.read(remaining)
+                    remaining = 0
+                dict_part, stream_part = (head[body_start:m.end()], head[m.end():]) if m else (head[body_start:], b"")
+                new_offsets[renumber[num]] = w.pos
+                w.write(b"%d 0 obj" % renumber[num])
+                w.write(_REF.sub(sub_ref, dict_part))
+                w.write(stream_part)
+                while remaining:
+                    chunk = f.read(min(_COPY_CHUNK, remaining))
+                    remaining -= len(chunk)
+                    w.write(chunk)
+
+    new_offsets[2] = w.pos
+    w.write(b"2 0 obj\n<<\n/Count %d /Kids [ %s ] /Type /Pages\n>>\nendobj\n"
+            % (len(kids), b" ".join(b"%d 0 R" % k for k in kids)))
+    new_offsets[1] = w.pos
+    w.write(b"1 0 obj\n<<\n/PageMode /UseNone /Pages 2 0 R /Type /Catalog\n>>\nendobj\n")
+
+    xref_pos = w.pos
+    w.write(b"xref\n0 %d\n0000000000 65535 f \n" % next_num)
+    for num in range(1, next_num):
+        w.write(b"%010d 00000 n \n" % new_offsets[num])
+    w.write(b"trailer\n<<\n/Root 1 0 R /Size %d\n>>\nstartxref\n%d\n%%%%EOF\n" % (next_num, xref_pos))
+    return len(kids)
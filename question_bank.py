@@ -0,0 +1,367 @@
+# question_bank.py
+# Question banks stored outside the script: JSON Lines (one record per line) or
+# SQLite.  Both keep indexes on the fields booklets are usually cut by, so
+# building a booklet only reads the selected records instead of the whole bank.
+# QuestionIndex does the same for a list of records held in memory.
+#
+# Filters map a field to one allowed value or a list of them.  Besides record
+# fields they accept "year" and "paper" (derived from exam_series and
+# original_ref, see derived_fields) and the marks bounds "min_marks" and
+# "max_marks".  order_by is a list of fields, "-" in front for descending;
+# ties keep bank order.
+
+import os, re, json, sqlite3, tempfile
+from bisect import bisect_left, bisect_right
+
+from image_cache import replace_file
+
+INDEXED_FIELDS = ("chapter_title", "exam_series", "original_ref")
+DERIVED_FIELDS = ("year", "paper")
+RANGE_FILTERS = ("min_marks", "max_marks")
+
+# bump when derived_fields changes, so saved indexes are rebuilt
+DERIVED_VERSION = 2
+
+# e.g. "5054_s17_qp_22 Q2": syllabus 5054, May/Jun (s) 2017, paper 22 ("sp20": specimen 2020)
+_REF_RE = re.compile(r"(\d{4})_([a-z]{1,2})(\d{2})_[a-z]{2}_(\d+)", re.IGNORECASE)
+_YEAR_RE = re.compile(r"\b(?:19|20)\d{2}\b")
+
+
+def derived_fields(rec):
+    """{"year": int, "paper": str} of a record (None where they can't be parsed).
+
+    The year is read from exam_series ("May/Jun 2014"), falling back to the
+    two-digit year of original_ref; the paper is the component code of
+    original_ref ("22" in "5054_s17_qp_22 Q2").
+    """
+    ref = _REF_RE.search(str(rec.get("original_ref") or ""))
+    series_year = _YEAR_RE.search(str(rec.get("exam_series") or ""))
+    if series_year:
+        year = int(series_year.group())
+    else:
+        year = 2000 + int(ref.group(3)) if ref else None
+    return {"year": year, "paper": ref.group(4) if ref else None}
+
+
+def _index_values(rec):
+    """(field, value) pairs a record is indexed under."""
+    for field in INDEXED_FIELDS:
+        yield field, rec.get(field)
+    yield from derived_fields(rec).items()
+
+
+def _marks(rec):
+    marks = rec.get("marks")
+    return marks if isinstance(marks, (int, float)) else 0
+
+
+def filter_questions(questions, filters):
+    """Keep records that match every filter (see the module comment for the filter keys)."""
+    if not filters:
+        return list(questions)
+    allowed, derived = {}, {}
+    lo = hi = None
+    for k, v in filters.items():
+        if k == "min_marks":
+            lo = v
+        elif k == "max_marks":
+            hi = v
+        else:
+            vals = v if isinstance(v, (list, tuple, set)) else [v]
+            if k in DERIVED_FIELDS:
+                derived[k] = {str(x) for x in vals}
+            else:
+                allowed[k] = set(vals)
+
+    def keep(q):
+        if not all(q.get(k) in vals for k, vals in allowed.items()):
+            return False
+        if (lo is not None and _marks(q) < lo) or (hi is not None and _marks(q) > hi):
+            return False
+        if derived:
+            d = derived_fields(q)
+            return all(str(d[k]) in vals for k, vals in derived.items())
+        return True
+    return [q for q in questions if keep(q)]
+
+
+def _sort_value(rec, field):
+    value = derived_fields(rec)[field] if field in DERIVED_FIELDS else rec.get(field)
+    if value is None:
+        return (2, "")
+    if isinstance(value, (int, float)):
+        return (0, value)
+    value = str(value)
+    # question numbers and paper codes sort numerically
+    return (0, int(value)) if value.isdigit() else (1, value)
+
+
+def sort_questions(questions, order_by=None):
+    """Records sorted by the fields in order_by (stable, so ties keep their order).
+
+    The booklet prints topics in order of first appearance, so the result is
+    grouped that way, and an end_of_topic question stays last in its topic.
+    """
+    questions = list(questions)
+    if not order_by:
+        return questions
+    for key in reversed(order_by):
+        field = key.lstrip("-")
+        questions.sort(key=lambda q: _sort_value(q, field), reverse=key.startswith("-"))
+    topics = {}
+    for q in questions:
+        topics.setdefault(q.get("chapter_title"), ([], []))[bool(q.get("end_of_topic"))].append(q)
+    return [q for body, end in topics.values() for q in body + end]
+
+
+def _split_filters(filters, indexed_fields=INDEXED_FIELDS):
+    """Split filters into (indexed, remaining) and normalize indexed values to lists."""
+    indexed, rest = {}, {}
+    for k, v in (filters or {}).items():
+        if k in indexed_fields:
+            indexed[k] = list(v) if isinstance(v, (list, tuple, set)) else [v]
+        else:
+            rest[k] = v
+    return indexed, rest
+
+
+class QuestionIndex:
+    """Inverted indexes over records held in memory, built once per load.
+
+    Each value of INDEXED_FIELDS and DERIVED_FIELDS maps to the positions of the
+    records that have it, and marks are kept sorted for range filters, so
+    select() intersects position sets instead of rescanning every record.
+    """
+    def __init__(self, records):
+        self.records = list(records)
+        self._index = {field: {} for field in INDEXED_FIELDS + DERIVED_FIELDS}
+        for pos, rec in enumerate(self.records):
+            for field, value in _index_values(rec):
+                if value is not None:
+                    self._index[field].setdefault(str(value), []).append(pos)
+        by_marks = sorted(range(len(self.records)), key=lambda pos: _marks(self.records[pos]))
+        self._by_marks = by_marks
+        self._marks = [_marks(self.records[pos]) for pos in by_marks]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def values(self, field):
+        """Distinct values of an indexed or derived field, in first-appearance order."""
+        return list(self._index[field])
+
+    def select(self, filters=None, order_by=None):
+        """Records matching filters, in bank order unless order_by is given."""
+        indexed, rest = _split_filters(filters, self._index)
+        selected = None
+        for field, vals in indexed.items():
+            hits = set()
+            for v in vals:
+                hits.update(self._index[field].get(str(v), ()))
+            selected = hits if selected is None else selected & hits
+        lo, hi = rest.pop("min_marks", None), rest.pop("max_marks", None)
+        if lo is not None or hi is not None:
+            i = 0 if lo is None else bisect_left(self._marks, lo)
+            j = len(self._marks) if hi is None else bisect_right(self._marks, hi)
+            hits = set(self._by_marks[i:j])
+            selected = hits if selected is None else selected & hits
+        positions = range(len(self.records)) if selected is None else sorted(selected)
+        records = filter_questions((self.records[pos] for pos in positions), rest)
+        return sort_questions(records, order_by)
+
+    def close(self):
+        pass
+
+
+class JsonlBank:
+    """Streaming JSON Lines bank.
+
+    One pass over the file records the byte offset of every record under each
+    indexed and derived field value; the index is kept next to the bank
+    (<path>.idx.json) and reused while the bank's size and mtime are unchanged.
+    select() then seeks straight to the matching lines.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx.json"
+        self._offsets, self._index = self._load_or_build_index()
+
+    def _stamp(self):
+        st = os.stat(self.path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def _load_or_build_index(self):
+        stamp = self._stamp()
+        fields = INDEXED_FIELDS + DERIVED_FIELDS
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                saved = json.load(f)
+            if (saved.get("stamp") == stamp and saved.get("fields") == list(fields)
+                    and saved.get("version") == DERIVED_VERSION):
+                return saved["offsets"], saved["index"]
+        except (OSError, ValueError):
+            pass
+
+        offsets = []
+        index = {field: {} for field in fields}
+        with open(self.path, "rb") as f:
+            pos = 0
+            for line in f:
+                if line.strip():
+                    rec = json.loads(line)
+                    offsets.append(pos)
+                    for field, value in _index_values(rec):
+                        if value is not None:
+                            index[field].setdefault(str(value), []).append(pos)
+                pos += len(line)
+        try:
+            # written aside and renamed: workers opening the bank together may all rebuild it
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.index_path)), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"stamp": stamp, "fields": list(fields), "version": DERIVED_VERSION,
+                           "offsets": offsets, "index": index}, f)
+            replace_file(tmp, self.index_path)
+        except OSError:
+            pass  # read-only location: the in-memory index still works
+        return offsets, index
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def values(self, field):
+        """Distinct values of an indexed or derived field, in first-appearance order."""
+        return list(self._index[field])
+
+    def _read(self, offsets):
+        with open(self.path, "rb") as f:
+            for pos in offsets:
+                f.seek(pos)
+                yield json.loads(f.readline())
+
+    def __iter__(self):
+        return self._read(self._offsets)
+
+    def select(self, filters=None, order_by=None):
+        """Records matching filters, in bank order unless order_by is given.
+
+        Only the lines the indexes select are parsed.
+        """
+        indexed, rest = _split_filters(filters, self._index)
+        if not indexed:
+            records = iter(self)
+        else:
+            selected = None
+            for field, vals in indexed.items():
+                hits = set()
+                for v in vals:
+                    hits.update(self._index[field].get(str(v), ()))
+                selected = hits if selected is None else selected & hits
+            records = self._read(sorted(selected))
+        return sort_questions(filter_questions(records, rest), order_by)
+
+    def close(self):
+        pass
+
+
+def _derived_columns(rec):
+    # derived values are stored as text, as the JSONL and in-memory indexes key them
+    return tuple(None if v is None else str(v) for v in derived_fields(rec).values())
+
+
+class SqliteBank:
+    """SQLite bank: one row per record (JSON text) plus indexed copies of INDEXED_FIELDS
+    and DERIVED_FIELDS.  The derived columns are recomputed when DERIVED_VERSION
+    (kept as the database's user_version) changes."""
+    COLUMNS = INDEXED_FIELDS + DERIVED_FIELDS
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self._ensure_schema()
+
+    def _ensure_schema(self):
+        cols = ", ".join(f"{field} TEXT" for field in self.COLUMNS)
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY, {cols}, record TEXT NOT NULL)")
+        have = {row[1] for row in self.conn.execute("PRAGMA table_info(questions)")}
+        for field in DERIVED_FIELDS:
+            if field not in have:
+                self.conn.execute(f"ALTER TABLE questions ADD COLUMN {field} TEXT")
+        for field in self.COLUMNS:
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_questions_{field} ON questions ({field})")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != DERIVED_VERSION:
+            rows = self.conn.execute("SELECT id, record FROM questions").fetchall()
+            assign = ", ".join(f"{field} = ?" for field in DERIVED_FIELDS)
+            self.conn.executemany(f"UPDATE questions SET {assign} WHERE id = ?",
+                                  ((*_derived_columns(json.loads(rec)), rid) for rid, rec in rows))
+            self.conn.execute(f"PRAGMA user_version = {DERIVED_VERSION}")
+        self.conn.commit()
+
+    def add(self, records):
+        """Append records in order (bank order is insertion order)."""
+        cols = ", ".join(self.COLUMNS)
+        marks = ", ".join("?" for _ in self.COLUMNS)
+        self.conn.executemany(
+            f"INSERT INTO questions ({cols}, record) VALUES ({marks}, ?)",
+            ((*(rec.get(f) for f in INDEXED_FIELDS), *_derived_columns(rec), json.dumps(rec, ensure_ascii=False))
+             for rec in records),
+        )
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM questions").fetchone()[0]
+
+    def values(self, field):
+        if field not in self.COLUMNS:
+            raise KeyError(field)
+        rows = self.conn.execute(f"SELECT {field} FROM questions WHERE {field} IS NOT NULL GROUP BY {field} ORDER BY MIN(id)")
+        return [r[0] for r in rows]
+
+    def __iter__(self):
+        for (record,) in self.conn.execute("SELECT record FROM questions ORDER BY id"):
+            yield json.loads(record)
+
+    def select(self, filters=None, order_by=None):
+        # marks filters are checked on the rows the indexed columns select
+        indexed, rest = _split_filters(filters, self.COLUMNS)
+        where, params = [], []
+        for field, vals in indexed.items():
+            where.append(f"{field} IN ({', '.join('?' for _ in vals)})")
+            params.extend(map(str, vals) if field in DERIVED_FIELDS else vals)
+        sql = "SELECT record FROM questions"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id"
+        records = (json.loads(r[0]) for r in self.conn.execute(sql, params))
+        return sort_questions(filter_questions(records, rest), order_by)
+
+    def close(self):
+        self.conn.close()
+
+
+def open_bank(path):
+    """Open a question bank by extension: .jsonl/.ndjson or .db/.sqlite/.sqlite3."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".jsonl", ".ndjson"):
+        return JsonlBank(path)
+    if ext in (".db", ".sqlite", ".sqlite3"):
+        return SqliteBank(path)
+    raise ValueError(f"unsupported question bank format: {path}")
+
+
+def import_jsonl_to_sqlite(jsonl_path, db_path, batch_size=1000):
+    """Stream a JSONL bank into a (new or existing) SQLite bank."""
+    bank = SqliteBank(db_path)
+    batch = []
+    with open(jsonl_path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                batch.append(json.loads(line))
+                if len(batch) >= batch_size:
+                    bank.add(batch)
+                    batch = []
+    if batch:
+        bank.add(batch)
+    return bank
@@ -0,0 +1,260 @@
+# service.py
+# Local HTTP endpoint around the booklet builder (asyncio, standard library only).
+#
+#   python service.py --port 8765 --bank bank.jsonl --workers 4
+#
+#   POST /booklet   {"filters": {"chapter_title": ["Thermal Physics"]}, "order_by": ["-year"], "title": "..."}
+#                   -> 200 application/pdf
+#   GET  /health    -> JSON with queue depth and cache counters
+#
+# Renders run in a process pool (the same worker setup as --batch).  Requests
+# are keyed like gp.booklet_key -- the selected records, the title, the layout
+# constants and the bytes each figure resolves to -- so identical requests in
+# flight share one render and finished PDFs are served from the cache
+# directory, which is an OutputCache (aged out and size-bounded like the CLI's).  Once max_pending distinct renders are queued or running, new
+# ones get 503 with Retry-After instead of piling up.  Every response carries a
+# Server-Timing header (queue, build, total).
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse, asyncio, json, os, tempfile, time
+
+import generate_pdf as gp
+from image_cache import CACHE_ROOT, ImageCache
+from output_cache import OutputCache, DEFAULT_OUTPUT_MAX_BYTES, DEFAULT_OUTPUT_MAX_AGE
+from question_bank import RANGE_FILTERS, QuestionIndex, open_bank
+
+DEFAULT_PORT = 8765
+DEFAULT_SERVICE_CACHE_DIR = os.path.join(CACHE_ROOT, "service")
+MAX_BODY_BYTES = 1 << 20
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class BookletService:
+    """Request handling: dedup of in-flight renders, PDF cache, backpressure."""
+    def __init__(self, questions=None, workers=None, max_pending=16, cache_dir=DEFAULT_SERVICE_CACHE_DIR,
+                 cache_max_bytes=DEFAULT_OUTPUT_MAX_BYTES, cache_max_age=DEFAULT_OUTPUT_MAX_AGE):
+        self.questions = questions if questions is not None else gp.SAMPLE_QUESTIONS
+        self.cache_dir = cache_dir
+        self.cache = OutputCache(cache_dir, cache_max_bytes, cache_max_age)
+        self.max_pending = max_pending
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=gp._init_batch_worker,
+                                        initargs=(self.questions,))
+        self._inflight = {}
+        self.stats = {"requests": 0, "cache_hits": 0, "shared": 0, "renders": 0, "rejected": 0}
+        # request keys are computed off the event loop on one thread, which also
+        # owns the bank (SQLite connections stay on the thread that opened them)
+        self._keyer = ThreadPoolExecutor(max_workers=1)
+        self._bank = None
+        self.image_cache = ImageCache()
+
+    def request_key(self, filters, title, order_by=None):
+        """gp.booklet_key of the selection: records, title, layout_params and figure digests.
+
+        URL figures are revalidated here (a conditional GET each), so a changed
+        figure or layout constant never serves a stale cached PDF.
+        """
+        if self._bank is None:
+            self._bank = open_bank(self.questions) if isinstance(self.questions, str) \
+                else QuestionIndex(self.questions)
+        questions = gp.normalize_questions(gp.select_questions(self._bank, filters, order_by))
+        images = gp.prefetch_images(gp.collect_image_refs(questions), cache=self.image_cache)
+        return gp.booklet_key(questions, title, images)
+
+    async def booklet(self, filters, title, order_by=None):
+        """Return (status, body bytes, content type, extra headers) for one selection."""
+        t0 = time.perf_counter()
+        self.stats["requests"] += 1
+        try:
+            key = await asyncio.get_running_loop().run_in_executor(self._keyer, self.request_key,
+                                                                   filters, title, order_by)
+        except Exception as e:
+            return 500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode("utf-8"), "application/json", {}
+        hit = self.cache.get(key)
+        cache = "hit"
+        result = None
+        if hit is None:
+            task = self._inflight.get(key)
+            if task:
+                cache = "shared"
+                self.stats["shared"] += 1
+            elif len(self._inflight) >= self.max_pending:
+                self.stats["rejected"] += 1
+                return 503, b'{"error": "too many pending renders"}', "application/json", {"Retry-After": "2"}
+            else:
+                cache = "miss"
+                task = asyncio.ensure_future(self._render(key, filters, title, order_by))
+                self._inflight[key] = task
+            result = await asyncio.shield(task)
+            hit = self.cache.get(key) if result["ok"] else None
+        else:
+            self.stats["cache_hits"] += 1
+
+        total = time.perf_counter() - t0
+        build = min(result["seconds"], total) if result else 0.0
+        headers = {
+            "X-Cache": cache,
+            "Server-Timing": f"queue;dur={(total - build) * 1000:.1f}, build;dur={build * 1000:.1f}, "
+                             f"total;dur={total * 1000:.1f}",
+        }
+        if result and not result["ok"]:
+            status = 404 if "no questions match" in result["error"] else 500
+            return status, json.dumps({"error": result["error"]}).encode("utf-8"), "application/json", headers
+        try:
+            if hit is None:
+                raise OSError("evicted before it was served")
+            with open(hit[0], "rb") as f:
+                body = f.read()
+        except OSError:
+            return 503, b'{"error": "cache entry evicted, retry"}', "application/json", {"Retry-After": "1", **headers}
+        headers["X-Pages"] = str(hit[1]["page_count"])
+        return 200, body, "application/pdf", headers
+
+    async def _render(self, key, filters, title, order_by=None):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        spec = {"output": tmp, "filters": filters, "title": title, "order_by": order_by}
+        try:
+            self.stats["renders"] += 1
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(self.pool, gp._build_spec, spec)
+            except Exception as e:
+                # the worker itself died (e.g. BrokenProcessPool)
+                result = {"ok": False, "error": f"{type(e).__name__}: {e}", "seconds": 0.0}
+            if result["ok"]:
+                self.cache.put(key, tmp, result["page_map"])
+            return result
+        finally:
+            self._inflight.pop(key, None)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def health(self):
+        return {"pending": len(self._inflight), "max_pending": self.max_pending, **self.stats}
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        self._keyer.shutdown(cancel_futures=True)
+
+
+def check_filters(filters):
+    """Raise ValueError unless filters holds values the selection can compare."""
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+    for field, value in filters.items():
+        if field in RANGE_FILTERS:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{field} must be a number")
+            continue
+        values = value if isinstance(value, list) else [value]
+        if not all(v is None or isinstance(v, (str, int, float)) for v in values):
+            raise ValueError(f"{field} must be a value or a list of values")
+
+
+# -------------------------
+# Minimal HTTP/1.1 front end (one request per connection)
+# -------------------------
+async def _read_request(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    method, target, _ = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > MAX_BODY_BYTES:
+        return method, target, headers, None
+    body = await reader.readexactly(length) if length else b""
+    return method, target, headers, body
+
+
+def _response(status, body, content_type, headers=None):
+    out = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+           f"Content-Type: {content_type}",
+           f"Content-Length: {len(body)}",
+           "Connection: close"]
+    out += [f"{k}: {v}" for k, v in (headers or {}).items()]
+    return ("\r\n".join(out) + "\r\n\r\n").encode("latin-1") + body
+
+
+def _json(status, obj, headers=None):
+    return _response(status, json.dumps(obj).encode("utf-8"), "application/json", headers)
+
+
+async def _handle(service, reader, writer):
+    try:
+        try:
+            method, target, headers, body = await _read_request(reader)
+        except (asyncio.IncompleteReadError, ValueError):
+            writer.write(_json(400, {"error": "malformed request"}))
+            return
+        path = target.split("?", 1)[0]
+        if path == "/health" and method == "GET":
+            writer.write(_json(200, service.health()))
+        elif path == "/booklet" and method == "POST":
+            if body is None:
+                writer.write(_json(413, {"error": "request body too large"}))
+                return
+            try:
+                req = json.loads(body or b"{}")
+                filters = req.get("filters") or {}
+                title = req.get("title") or gp.DEFAULT_TITLE
+                order_by = req.get("order_by")
+                check_filters(filters)
+                if order_by is not None and not (isinstance(order_by, list)
+                                                 and all(isinstance(k, str) for k in order_by)):
+                    raise ValueError("order_by must be a list of field names")
+            except (ValueError, AttributeError) as e:
+                writer.write(_json(400, {"error": f"bad request body: {e}"}))
+                return
+            status, payload, content_type, extra = await service.booklet(filters, title, order_by)
+            writer.write(_response(status, payload, content_type, extra))
+        elif path in ("/health", "/booklet"):
+            writer.write(_json(405, {"error": "method not allowed"}))
+        else:
+            writer.write(_json(404, {"error": "not found"}))
+    finally:
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+
+async def serve(service, host="127.0.0.1", port=DEFAULT_PORT):
+    server = await asyncio.start_server(lambda r, w: _handle(service, r, w), host, port)
+    print(f"Serving booklets on http://{host}:{port}/booklet")
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP service that builds booklet PDFs on request.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--bank", help="question bank (.jsonl/.db) or .json list; default: sample questions")
+    parser.add_argument("--workers", type=int, help="render processes (default: CPU count)")
+    parser.add_argument("--max-pending", type=int, default=16, help="distinct renders queued before answering 503")
+    parser.add_argument("--cache-dir", default=DEFAULT_SERVICE_CACHE_DIR, help="finished PDFs (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    questions = None
+    if args.bank and args.bank.lower().endswith(".json"):
+        with open(args.bank, encoding="utf-8") as f:
+            questions = json.load(f)
+    elif args.bank:
+        questions = os.path.abspath(args.bank)
+    service = BookletService(questions, args.workers, args.max_pending, args.cache_dir)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,162 @@
+# tests/test_image_cache.py
+# Revalidation and eviction checks for image_cache, against a local HTTP stand-in,
+# and for the prepared-image cache.
+# Run with: python -m unittest discover tests   (or python -m pytest tests)
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import os, sys, tempfile, threading, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import image_cache  # noqa: E402
+from image_cache import ImageCache, evict_prepared, prefetch_images, prepare_image  # noqa: E402
+
+LAST_MODIFIED = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+
+class FigureServer(ThreadingHTTPServer):
+    """Serves /<name>.png as name-derived bytes, with an ETag and Last-Modified."""
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FigureHandler)
+        self.hits = []
+        self.version = 1
+
+    def body(self, path):
+        return (f"{path} v{self.version}".encode("utf-8") * 256)[:1024]
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.server_port}/{name}.png"
+
+
+class FigureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        etag = f'"{server.version}"'
+        conditional = self.headers.get("If-None-Match") or self.headers.get("If-Modified-Since")
+        server.hits.append((self.path, conditional))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = server.body(self.path)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FigureServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, "images")
+        # eviction normally spares anything touched in the last few minutes
+        patcher = mock.patch.object(image_cache, "EVICT_GRACE", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def cache(self, max_bytes=image_cache.DEFAULT_MAX_BYTES):
+        # a fresh instance per build, reading the index the previous one saved
+        return ImageCache(self.cache_dir, max_bytes=max_bytes)
+
+    def objects_on_disk(self):
+        return sorted(n for n in os.listdir(self.cache_dir)
+                      if n != "index.json" and not n.endswith((".tmp", ".lock")))
+
+    def test_etag_304_reuses_cached_object(self):
+        url = self.server.url("a")
+        first = prefetch_images([url], cache=self.cache())[url]
+        second = prefetch_images([url], cache=self.cache())[url]
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.hits, [("/a.png", None), ("/a.png", '"1"')])
+        self.assertEqual(len(self.objects_on_disk()), 1)
+
+    def test_changed_figure_is_refetched(self):
+        url = self.server.url("a")
+        first = prefetch_images([url], cache=self.cache())[url]
+        self.server.version = 2
+        second = prefetch_images([url], cache=self.cache())[url]
+        self.assertNotEqual(first, second)
+        with open(second, "rb") as f:
+            self.assertEqual(f.read(), self.server.body("/a.png"))
+
+    def test_duplicate_refs_fetched_once(self):
+        url = self.server.url("a")
+        prefetch_images([url, url, url], cache=self.cache())
+        self.assertEqual(len(self.server.hits), 1)
+
+    def test_evicts_least_recently_used_first(self):
+        urls = [self.server.url(n) for n in "abc"]
+        for url in urls:
+            prefetch_images([url], cache=self.cache())
+            time.sleep(0.01)
+        prefetch_images([urls[0]], cache=self.cache())   # a is now the most recent
+        # room for two objects: adding d must push out b and c, the least recently used
+        d = self.server.url("d")
+        resolved = prefetch_images([d], cache=self.cache(max_bytes=2 * 1024))
+        cache = self.cache()
+        kept = {url for url in urls + [d] if cache._cached(url)[1]}
+        self.assertEqual(kept, {urls[0], d})
+        self.assertTrue(os.path.exists(resolved[d]))
+
+    def test_size_bound(self):
+        max_bytes = 3 * 1024
+        for n in "abcdefgh":
+            prefetch_images([self.server.url(n)], cache=self.cache(max_bytes=max_bytes))
+        total = sum(os.path.getsize(os.path.join(self.cache_dir, n)) for n in self.objects_on_disk())
+        self.assertLessEqual(total, max_bytes)
+        index = self.cache()._index
+        self.assertEqual(sorted(index["objects"]), self.objects_on_disk())
+        self.assertTrue(all(e["object"] in index["objects"] for e in index["urls"].values()))
+
+    def test_current_build_is_never_evicted(self):
+        urls = [self.server.url(n) for n in "abcd"]
+        resolved = prefetch_images(urls, cache=self.cache(max_bytes=1024))
+        for url in urls:
+            self.assertTrue(os.path.exists(resolved[url]), url)
+
+    def figure(self, name, size=(1600, 900)):
+        from PIL import Image
+        path = os.path.join(self.tmp.name, name + ".png")
+        Image.new("L", size, hash(name) % 256).save(path)
+        return path
+
+    def test_prepared_lru_and_size_bound(self):
+        prepared_dir = os.path.join(self.tmp.name, "prepared")
+        paths = []
+        now = time.time()
+        for i, name in enumerate("abc"):
+            paths.append(prepare_image(self.figure(name), 200, 100, cache_dir=prepared_dir))
+            os.utime(paths[-1], (now - 100 + i, now - 100 + i))
+        prepare_image(self.figure("a"), 200, 100, cache_dir=prepared_dir)   # a is used again
+        # room for two: b, now the least recently used, goes
+        evict_prepared(prepared_dir, max_bytes=os.path.getsize(paths[0]) + os.path.getsize(paths[2]))
+        self.assertEqual([os.path.exists(p) for p in paths], [True, False, True])
+
+    def test_failed_prepare_leaves_no_tmp(self):
+        from PIL import Image
+        prepared_dir = os.path.join(self.tmp.name, "prepared")
+        source = self.figure("a")
+        with mock.patch.object(Image.Image, "save", side_effect=OSError("disk full")):
+            self.assertIsNone(prepare_image(source, 200, 100, cache_dir=prepared_dir))
+        self.assertEqual(os.listdir(prepared_dir), [])
+
+    def test_vanished_file_is_a_missing_figure(self):
+        path = os.path.join(self.tmp.name, "gone.png")
+        self.assertIsNone(prepare_image(path, 100, 100, cache_dir=os.path.join(self.tmp.name, "prepared")))
+
+
+if __name__ == "__main__":
+    unittest.main()